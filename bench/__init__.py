@@ -0,0 +1 @@
+"""Offline benchmarks and load tests, run from the repository root with ``python -m bench.<name>``."""
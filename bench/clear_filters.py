@@ -0,0 +1,99 @@
+"""Cost of the /clear predicates, the old per-command lambdas against ``MessageFilter``.
+
+Each command's predicate is run over the same synthetic history in one pass, once as the
+lambda the command used to build and once as the ``MessageFilter`` it builds now. ``combined``
+is a /clear filter with several criteria at once, written the way the old lambdas were for the
+comparison. The filters run the way the purge job runs them, through their compiled ``check``
+and stopping at their age window. Both sides must match the same messages.
+
+    python -m bench.clear_filters --messages 100000
+"""
+import argparse
+import datetime
+import random
+import time
+
+import discord
+
+from bench.fake_discord import FakeMessage, FakeUser
+from filters import MessageFilter
+
+WORDS = ("hello", "raid", "giveaway", "invite", "role", "nitro", "spam", "welcome", "free", "link")
+
+
+def history(count: int) -> tuple[list[FakeMessage], FakeUser]:
+    """``count`` messages of the last 30 days, newest first, and the member who wrote a tenth of them."""
+    random.seed(count)
+    target = FakeUser(1, "target")
+    people = [target] + [FakeUser(user_id, bot=user_id % 5 == 0) for user_id in range(2, 11)]
+    now = discord.utils.utcnow()
+    messages = []
+    for _ in range(count):
+        created = now - datetime.timedelta(seconds=random.uniform(0, 30 * 86400))
+        message = FakeMessage(None, discord.utils.time_snowflake(created) + random.randrange(1 << 22),
+                              random.choice(people), " ".join(random.choices(WORDS, k=random.randint(1, 12))),
+                              attachments=random.random() < 0.1, embeds=random.random() < 0.1,
+                              pinned=random.random() < 0.01)
+        if random.random() < 0.05:
+            message.mentions.append(random.choice(people))
+        messages.append(message)
+    messages.sort(key=lambda message: message.id, reverse=True)
+    return messages, target
+
+
+def predicates(user: FakeUser) -> dict[str, tuple]:
+    """The old lambda and the current filter of every command, keyed by command."""
+    word = "Raid"
+    newer, older = datetime.timedelta(days=20), datetime.timedelta(days=2)
+    now = discord.utils.utcnow()
+    return {
+        "default": (lambda m: not m.pinned, MessageFilter()),
+        "bot": (lambda m: m.author.bot and not m.pinned, MessageFilter(bot=True)),
+        "member": (lambda m: m.author == user and not m.pinned, MessageFilter(author=user.id)),
+        "contains": (lambda m: word.lower() in m.content.lower() and not m.pinned, MessageFilter(contains=word)),
+        "startswith": (lambda m: m.content.lower().startswith(word.lower()) and not m.pinned,
+                       MessageFilter(startswith=word)),
+        "attachment": (lambda m: len(m.attachments) > 0 and not m.pinned, MessageFilter(attachments=True)),
+        "embeds": (lambda m: len(m.embeds) > 0 and not m.pinned, MessageFilter(embeds=True)),
+        "mentions": (lambda m: (len(m.mentions) > 0 or len(m.channel_mentions) > 0 or len(m.role_mentions) > 0)
+                     and not m.pinned, MessageFilter(mentions=True)),
+        "combined": (lambda m: not m.author.bot and word.lower() in m.content.lower() and len(m.attachments) == 0
+                     and now - newer <= m.created_at <= now - older and not m.pinned,
+                     MessageFilter(bot=False, contains=word, attachments=False, newer_than=newer, older_than=older)),
+    }
+
+
+def scan(messages: list[FakeMessage], check, min_id: int = 0) -> tuple[int, float]:
+    """Run ``check`` over the history in one pass like a purge job, returning the matches and the time it took.
+
+    The pass stops at the first message older than ``min_id``, as the purge job does.
+    """
+    started = time.perf_counter()
+    matched = 0
+    for message in messages:
+        if message.id < min_id:
+            break
+        if check(message):
+            matched += 1
+    return matched, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5, help="Passes per predicate, the fastest one counts")
+    args = parser.parse_args()
+    messages, user = history(args.messages)
+    print(f"{'command':<11} {'matched':>8} {'lambda':>9} {'filter':>9} {'speedup':>8}")
+    for command, (old, new) in predicates(user).items():
+        old_matched, old_took = min((scan(messages, old) for _ in range(args.repeat)), key=lambda run: run[1])
+        new_matched, new_took = min((scan(messages, new.check, new.min_id) for _ in range(args.repeat)),
+                                    key=lambda run: run[1])
+        if old_matched != new_matched:
+            raise SystemExit(f"{command}: the lambda matched {old_matched} messages, the filter {new_matched}")
+        print(f"{command:<11} {new_matched:>8} {old_took * 1000:>7.1f}ms {new_took * 1000:>7.1f}ms "
+              f"{old_took / new_took:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
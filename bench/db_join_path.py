@@ -0,0 +1,144 @@
+"""Database cost of handling joins, before and after the persistent database layer.
+
+``before`` replays the queries the join path used to run: a fresh ``sqlite3`` connection
+for the default role lookup and another one to read the guild's invites and count the use,
+all on the event loop. ``after`` is the current path, where the default roles come from the
+config cache and uses and attributed joins go through the write-behind buffer on the
+database thread. A ticker task measures how long the event loop stalls meanwhile.
+
+    python -m bench.db_join_path --joins 5000 --guilds 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import database
+from guild_config import GuildConfigCache
+from invite_writes import InviteWriteBuffer
+
+INVITES_PER_GUILD = 20
+TICK = 0.005
+
+
+class LoopLag:
+    """Samples how late the event loop runs a task that asks to wake up every ``TICK`` seconds."""
+
+    def __init__(self):
+        self.samples: list[float] = []
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            expected = time.perf_counter() + TICK
+            await asyncio.sleep(TICK)
+            self.samples.append(max(time.perf_counter() - expected, 0.0))
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def summary(self) -> str:
+        if not self.samples:
+            return "no samples"
+        samples = sorted(self.samples)
+        return (f"loop lag p50 {statistics.median(samples) * 1000:.1f}ms, "
+                f"p99 {samples[int(len(samples) * 0.99)] * 1000:.1f}ms, max {samples[-1] * 1000:.1f}ms")
+
+
+def joins(count: int, guilds: int) -> list[tuple[int, str]]:
+    random.seed(count)
+    return [(guild_id := random.randrange(guilds), f"g{guild_id}i{random.randrange(INVITES_PER_GUILD)}")
+            for _ in range(count)]
+
+
+def _baseline_db(path: str, guilds: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE invites (_id INTEGER PRIMARY KEY, invite_id TEXT UNIQUE, guild_id TEXT,
+                 role_id INTEGER, inviter INTEGER, uses INTEGER DEFAULT 0, max_uses INTEGER, duration INTEGER,
+                 channel_id INTEGER)''')
+    conn.execute("CREATE TABLE default_roles (guild_id TEXT PRIMARY KEY, role_id INTEGER)")
+    conn.executemany("INSERT INTO invites (invite_id, guild_id, role_id, inviter, uses) VALUES (?, ?, ?, 1, 0)",
+                     ((f"g{g}i{i}", str(g), i) for g in range(guilds) for i in range(INVITES_PER_GUILD)))
+    conn.executemany("INSERT INTO default_roles VALUES (?, 99)", ((str(g),) for g in range(guilds)))
+    conn.commit()
+    conn.close()
+
+
+async def before(path: str, stream: list[tuple[int, str]], guilds: int) -> float:
+    _baseline_db(path, guilds)
+
+    async def join(guild_id: int, code: str) -> None:
+        await asyncio.sleep(0)  # Where the handler awaited the invite fetch
+        conn = sqlite3.connect(path)
+        conn.execute("SELECT role_id FROM default_roles WHERE guild_id = ?", (str(guild_id),)).fetchone()
+        conn.close()
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT invite_id, role_id, uses FROM invites WHERE guild_id = ?", (str(guild_id),))
+        for invite_id, role_id, uses in cursor.fetchall():
+            if invite_id == code:
+                cursor.execute("UPDATE invites SET uses = uses + 1 WHERE invite_id = ?", (invite_id,))
+                conn.commit()
+                break
+        conn.close()
+
+    started = time.perf_counter()
+    for guild_id, code in stream:
+        await join(guild_id, code)
+    return time.perf_counter() - started
+
+
+async def after(path: str, stream: list[tuple[int, str]], guilds: int) -> float:
+    database.DB_PATH = path
+    database.init_db()
+    for g in range(guilds):
+        for i in range(INVITES_PER_GUILD):
+            await database.save_invite(f"g{g}i{i}", g, i, 1, 0, 0, 0, 0)
+        await database.set_default_roles(g, [99])
+    configs = GuildConfigCache()
+    await configs.load()
+    writes = InviteWriteBuffer()
+
+    async def join(guild_id: int, code: str, user_id: int) -> None:
+        await asyncio.sleep(0)
+        if configs.get(guild_id).default_roles:
+            writes.increment(code)
+            writes.attribute(guild_id, user_id, code, 1, time.time())
+
+    started = time.perf_counter()
+    for n, (guild_id, code) in enumerate(stream):
+        await join(guild_id, code, n)
+    await writes.close()  # Until everything is committed
+    took = time.perf_counter() - started
+    database.close_db()
+    return took
+
+
+async def run(path: str, mode: str, stream: list[tuple[int, str]], guilds: int) -> None:
+    with LoopLag() as lag:
+        took = await (before if mode == "before" else after)(path, stream, guilds)
+    print(f"{mode:>6}: {len(stream)} joins in {took:.2f}s, {len(stream) / took:,.0f} joins/s, {lag.summary()}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--joins", type=int, default=5000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--mode", choices=("before", "after", "both"), default="both")
+    args = parser.parse_args()
+    stream = joins(args.joins, args.guilds)
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ("before", "after") if args.mode == "both" else (args.mode,):
+            asyncio.run(run(os.path.join(directory, f"{mode}.db"), mode, stream, args.guilds))
+
+
+if __name__ == "__main__":
+    main()
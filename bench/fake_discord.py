@@ -0,0 +1,377 @@
+"""Stand-ins for the parts of discord.py the cogs touch, backed by a fake gateway and HTTP layer.
+
+Every call that would hit the REST API goes through ``FakeHTTP``, which counts it per route,
+adds a round-trip latency and makes it wait for its rate-limit bucket the way discord.py
+does. Gateway events are delivered by ``FakeGateway`` in order and after a delay, so an
+invite fetch can already include uses of joins whose events have not arrived yet.
+"""
+import asyncio
+import collections
+import copy
+import datetime
+import random
+import time
+import typing
+
+import discord
+
+# (requests, per seconds) of each bucket, keyed by route and scoped by the route's major parameter.
+# Modelled on the limits Discord reports in its rate-limit headers for a bot in a few guilds.
+BUCKETS: dict[str, tuple[int, float]] = {
+    "GET /guilds/{guild_id}/invites": (5, 5.0),
+    "PATCH /guilds/{guild_id}/members/{user_id}": (10, 10.0),
+    "POST /channels/{channel_id}/invites": (5, 5.0),
+    "DELETE /invites/{invite_code}": (5, 5.0),
+    "GET /channels/{channel_id}/messages": (5, 5.0),
+    "POST /channels/{channel_id}/messages/bulk-delete": (1, 1.0),
+    "DELETE /channels/{channel_id}/messages/{message_id}": (5, 5.0),
+    "PATCH /webhooks/{application_id}/{interaction_token}/messages/@original": (5, 5.0),
+}
+GLOBAL_LIMIT = (50, 1.0)
+
+
+class FakeResponse:
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+
+class Bucket:
+    """Allows ``limit`` requests per ``per`` seconds, later requests wait for the window to reset."""
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self._sent: collections.deque[float] = collections.deque()
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and return how long that took."""
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            while self._sent and now - self._sent[0] >= self.per:
+                self._sent.popleft()
+            if len(self._sent) < self.limit:
+                self._sent.append(now)
+                return waited
+            delay = self.per - (now - self._sent[0])
+            waited += delay
+            await asyncio.sleep(delay)
+
+
+class FakeHTTP:
+    """Counts, delays and rate limits every REST request."""
+
+    def __init__(self, latency: float = 0.05, time_scale: float = 1.0):
+        self.latency = latency
+        self.time_scale = time_scale
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.rate_limited: collections.Counter[str] = collections.Counter()
+        self.errors: dict[str, list[int]] = {}  # route: statuses to fail the next requests with
+        self._buckets: dict[tuple[str, int], Bucket] = {}
+        self._global = Bucket(GLOBAL_LIMIT[0], GLOBAL_LIMIT[1] * time_scale)
+
+    def fail(self, route: str, *statuses: int) -> None:
+        """Make the next requests to ``route`` fail with ``statuses``, in order."""
+        self.errors.setdefault(route, []).extend(statuses)
+
+    async def request(self, route: str, major: int) -> None:
+        self.requests[route] += 1
+        bucket = self._buckets.get((route, major))
+        if bucket is None:
+            limit, per = BUCKETS[route]
+            bucket = self._buckets[(route, major)] = Bucket(limit, per * self.time_scale)
+        if await bucket.acquire() + await self._global.acquire():
+            self.rate_limited[route] += 1
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if statuses := self.errors.get(route):
+            status = statuses.pop(0)
+            if status == 403:
+                raise discord.Forbidden(FakeResponse(403, "Forbidden"), "Missing Permissions")
+            if status == 404:
+                raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown")
+            raise discord.HTTPException(FakeResponse(status, "Error"), "Fake error")
+
+    def snapshot(self) -> dict[str, dict[str, int]]:
+        return {"requests": dict(self.requests), "rate_limited": dict(self.rate_limited)}
+
+
+class FakeGateway:
+    """Delivers events to the listeners of the cogs in order, each ``latency`` seconds after it happened."""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.cogs: list[typing.Any] = []
+        self.events: collections.Counter[str] = collections.Counter()
+        self._queue: asyncio.Queue[tuple[float, str, tuple]] = asyncio.Queue()
+        self._due = 0.0
+        self._task: typing.Optional[asyncio.Task] = None
+        self._handlers: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def dispatch(self, event: str, *args) -> None:
+        self._due = max(self._due, time.monotonic() + random.uniform(0.5, 1.5) * self.latency)
+        self._queue.put_nowait((self._due, event, args))
+
+    async def _run(self) -> None:
+        while True:
+            due, event, args = await self._queue.get()
+            if (delay := due - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            self.events[event] += 1
+            for cog in self.cogs:
+                if handler := getattr(cog, f"on_{event}", None):
+                    task = asyncio.create_task(handler(*args))
+                    self._handlers.add(task)
+                    task.add_done_callback(self._handlers.discard)
+            self._queue.task_done()
+
+    async def drain(self) -> None:
+        """Wait until every dispatched event has been handled."""
+        await self._queue.join()
+        while self._handlers:
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str = "", bot: bool = False):
+        self.id = user_id
+        self.name = self.display_name = name or f"user{user_id}"
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id = role_id
+        self.name = f"role{role_id}"
+        self.mention = f"<@&{role_id}>"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return self.id
+
+
+class FakeInvite:
+    def __init__(self, code: str, guild: "FakeGuild", channel: "FakeChannel", inviter: FakeUser,
+                 max_uses: int = 0, max_age: int = 0):
+        self.code = self.id = code
+        self.guild = guild
+        self.channel = channel
+        self.inviter = inviter
+        self.uses = 0
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.expires_at = discord.utils.utcnow() + datetime.timedelta(seconds=max_age) if max_age else None
+        self.url = f"https://discord.gg/{code}"
+
+
+class FakeMember(FakeUser):
+    def __init__(self, guild: "FakeGuild", user_id: int, pending: bool = False):
+        super().__init__(user_id)
+        self.guild = guild
+        self.pending = pending
+        self.roles: list[FakeRole] = []
+        self.joined_at = discord.utils.utcnow()
+        self.roles_at: typing.Optional[float] = None  # Monotonic time the last role edit went through
+
+    async def add_roles(self, *roles: FakeRole, atomic: bool = True, reason: typing.Optional[str] = None) -> None:
+        await self.guild.http.request("PATCH /guilds/{guild_id}/members/{user_id}", self.guild.id)
+        self.roles.extend(role for role in roles if role not in self.roles)
+        self.roles_at = time.monotonic()
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", message_id: int, author: FakeUser, content: str = "",
+                 attachments: int = 0, embeds: int = 0, pinned: bool = False):
+        self.channel = channel
+        self.id = message_id
+        self.author = author
+        self.content = content
+        self.attachments = [object()] * attachments
+        self.embeds = [object()] * embeds
+        self.mentions: list = []
+        self.channel_mentions: list = []
+        self.role_mentions: list = []
+        self.pinned = pinned
+        self.created_at = discord.utils.snowflake_time(message_id)
+
+    async def delete(self) -> None:
+        await self.channel.http.request("DELETE /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        if self.channel.messages.pop(self.id, None) is None:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+
+
+class FakeChannel:
+    PAGE_SIZE = 100
+
+    def __init__(self, guild: "FakeGuild", channel_id: int):
+        self.guild = guild
+        self.http = guild.http
+        self.id = channel_id
+        self.name = f"channel{channel_id}"
+        self.position = 0
+        self.messages: dict[int, FakeMessage] = {}
+
+    async def create_invite(self, max_age: int = 0, max_uses: int = 0, reason: typing.Optional[str] = None,
+                            inviter: typing.Optional[FakeUser] = None) -> FakeInvite:
+        await self.http.request("POST /channels/{channel_id}/invites", self.id)
+        invite = FakeInvite(f"inv{next(self.guild.ids)}", self.guild, self, inviter or self.guild.bot.user,
+                            max_uses, max_age)
+        self.guild.invites_by_code[invite.code] = invite
+        self.guild.gateway.dispatch("invite_create", copy.copy(invite))
+        return invite
+
+    async def history(self, limit: typing.Optional[int] = 100, before=None) -> typing.AsyncIterator[FakeMessage]:
+        ids = sorted((message_id for message_id in self.messages if before is None or message_id < before.id),
+                     reverse=True)[:limit]
+        for start in range(0, len(ids), self.PAGE_SIZE):
+            await self.http.request("GET /channels/{channel_id}/messages", self.id)
+            for message_id in ids[start:start + self.PAGE_SIZE]:
+                if message := self.messages.get(message_id):
+                    yield message
+
+    async def delete_messages(self, messages: list[FakeMessage]) -> None:
+        await self.http.request("POST /channels/{channel_id}/messages/bulk-delete", self.id)
+        cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - datetime.timedelta(days=14))
+        if len(messages) > 100 or any(message.id < cutoff for message in messages):
+            raise discord.HTTPException(FakeResponse(400, "Bad Request"), "Messages are too old or too many")
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+
+class FakeGuild:
+    def __init__(self, bot: "FakeBot", guild_id: int, role_ids: typing.Iterable[int]):
+        self.bot = bot
+        self.http = bot.http
+        self.gateway = bot.gateway
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.shard_id = 0
+        self.ids = bot.ids
+        self.roles = {role_id: FakeRole(role_id) for role_id in role_ids}
+        self.members: dict[int, FakeMember] = {}
+        self.invites_by_code: dict[str, FakeInvite] = {}
+        self.fetched: list[float] = []  # Monotonic time of every invite fetch, when its use counts were taken
+        self.system_channel = FakeChannel(self, next(self.ids))
+        self.public_updates_channel = None
+        self.text_channels = [self.system_channel]
+
+    def get_role(self, role_id: typing.Optional[int]) -> typing.Optional[FakeRole]:
+        return self.roles.get(role_id)
+
+    def get_member(self, user_id: int) -> typing.Optional[FakeMember]:
+        return self.members.get(user_id)
+
+    async def invites(self) -> list[FakeInvite]:
+        await self.http.request("GET /guilds/{guild_id}/invites", self.id)
+        self.fetched.append(time.monotonic())
+        return [copy.copy(invite) for invite in self.invites_by_code.values()]
+
+    def join(self, code: typing.Optional[str], pending: bool = False) -> FakeMember:
+        """A new member joins through the invite ``code``, the join event follows through the gateway."""
+        if code is not None:
+            invite = self.invites_by_code[code]
+            invite.uses += 1
+            if invite.max_uses and invite.uses >= invite.max_uses:
+                del self.invites_by_code[code]  # Used up, Discord removes it without an event
+        member = FakeMember(self, next(self.ids), pending)
+        self.members[member.id] = member
+        self.gateway.dispatch("member_join", member)
+        return member
+
+    def complete_screening(self, member: FakeMember) -> None:
+        before = copy.copy(member)
+        member.pending = False
+        self.gateway.dispatch("member_update", before, member)
+
+
+class FakeResponseHandle:
+    """``interaction.response``, recording what was sent."""
+
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def send_message(self, content: typing.Optional[str] = None, **kwargs) -> None:
+        self.done = True
+        self._interaction.sent.append(content or "")
+
+    async def defer(self, **kwargs) -> None:
+        self.done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send(self, content: typing.Optional[str] = None, **kwargs) -> None:
+        self._interaction.sent.append(content or "")
+
+
+class FakeInteraction:
+    def __init__(self, bot: "FakeBot", guild: FakeGuild, channel: FakeChannel, user: FakeUser):
+        self.client = bot
+        self.guild = guild
+        self.channel = channel
+        self.user = user
+        self.created_at = discord.utils.utcnow()
+        self.response = FakeResponseHandle(self)
+        self.followup = FakeFollowup(self)
+        self.sent: list[str] = []
+        self.edits: list[str] = []
+
+    async def edit_original_response(self, content: typing.Optional[str] = None, **kwargs) -> None:
+        await self.guild.http.request("PATCH /webhooks/{application_id}/{interaction_token}/messages/@original",
+                                      id(self))
+        self.edits.append(content or "")
+
+
+class FakeBot:
+    """What the cogs use of the bot: its guilds, shards and user, and deleting invites."""
+
+    def __init__(self, http: FakeHTTP, gateway: FakeGateway):
+        self.http = http
+        self.gateway = gateway
+        self.ids = iter(range(10 ** 17, 10 ** 18))
+        self.user = FakeUser(next(self.ids), "RoleInvite", bot=True)
+        self.application_id = self.user.id
+        self.shard_count = 1
+        self.shards = {0: None}
+        self.guilds: list[FakeGuild] = []
+
+    def add_guild(self, role_ids: typing.Iterable[int]) -> FakeGuild:
+        guild = FakeGuild(self, next(self.ids), role_ids)
+        self.guilds.append(guild)
+        return guild
+
+    def get_guild(self, guild_id: int) -> typing.Optional[FakeGuild]:
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    async def wait_until_ready(self) -> None:
+        pass
+
+    async def delete_invite(self, code: str) -> None:
+        await self.http.request("DELETE /invites/{invite_code}", 0)
+        for guild in self.guilds:
+            if invite := guild.invites_by_code.pop(code, None):
+                self.gateway.dispatch("invite_delete", invite)
+                return
+        raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Invite")
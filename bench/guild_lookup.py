@@ -0,0 +1,85 @@
+"""Per-guild invite lookups on the original schema and on the migrated one.
+
+``v1`` is the schema of the first migration: ``guild_id`` stored as TEXT and no index
+besides the unique ``invite_id``, so every ``WHERE guild_id = ?`` scans the whole table.
+``migrated`` runs the second migration over the same rows, which stores native INTEGER
+snowflakes and adds the per-guild indexes. Both time the queries the bot runs per guild.
+
+    python -m bench.guild_lookup --invites 2000000 --guilds 5000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import database
+
+GUILD_BASE = 10 ** 17  # Snowflake sized guild IDs
+
+
+def build(path: str, invites: int, guilds: int) -> sqlite3.Connection:
+    """Create the v1 schema and fill it with ``invites`` spread over ``guilds``, a tenth of them role invites."""
+    conn = sqlite3.connect(path, isolation_level=None)
+    for statement in database.MIGRATIONS[0]:
+        conn.execute(statement)
+    random.seed(invites)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO invites (invite_id, guild_id, role_id, inviter, uses, max_uses, duration, "
+                     "channel_id) VALUES (?, ?, ?, 1, ?, 0, 0, 1)",
+                     ((f"i{n}", str(GUILD_BASE + random.randrange(guilds)), n if n % 10 == 0 else None,
+                       random.randrange(100)) for n in range(invites)))
+    conn.execute("COMMIT")
+    return conn
+
+
+def migrate(conn: sqlite3.Connection) -> float:
+    started = time.perf_counter()
+    conn.execute("BEGIN")
+    for statement in database.MIGRATIONS[1]:
+        conn.execute(statement)
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    return time.perf_counter() - started
+
+
+def lookups(conn: sqlite3.Connection, guild_ids: list, label: str) -> None:
+    """Time a page of a guild's invites and its role invites for each of ``guild_ids``."""
+    queries = {
+        "page": "SELECT invite_id, role_id, uses, max_uses FROM invites WHERE guild_id = ? AND invite_id > '' "
+                "ORDER BY invite_id LIMIT 25",
+        "role invites": "SELECT invite_id, role_id, uses FROM invites WHERE guild_id = ? AND role_id",
+    }
+    for name, query in queries.items():
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", (guild_ids[0],)).fetchall()[-1][-1]
+        samples = []
+        for guild_id in guild_ids:
+            started = time.perf_counter()
+            conn.execute(query, (guild_id,)).fetchall()
+            samples.append(time.perf_counter() - started)
+        samples.sort()
+        print(f"{label:>8} {name:<12}: p50 {statistics.median(samples) * 1000:8.3f}ms, "
+              f"p99 {samples[int(len(samples) * 0.99)] * 1000:8.3f}ms ({plan})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invites", type=int, default=2_000_000)
+    parser.add_argument("--guilds", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=100, help="Guilds looked up per query, v1 scans every time")
+    args = parser.parse_args()
+    guilds = [GUILD_BASE + random.Random(0).randrange(args.guilds) for _ in range(args.lookups)]
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        conn = build(os.path.join(directory, "invites.db"), args.invites, args.guilds)
+        print(f"built {args.invites:,} invites over {args.guilds:,} guilds in {time.perf_counter() - started:.1f}s")
+        lookups(conn, [str(guild_id) for guild_id in guilds], "v1")
+        print(f"migrated in {migrate(conn):.1f}s")
+        lookups(conn, guilds, "migrated")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""Replays scripted event streams against the real RoleInvite and ClearCommands cogs.
+
+The cogs run unchanged on top of ``bench.fake_discord``, against a scratch database.
+Each scenario reports its throughput, join-to-role latency, attribution accuracy and the
+REST calls it made, and ``--json`` writes the same numbers to a file to compare runs.
+
+    python -m bench.load_test raid churn screening clear --json before.json
+
+The raid fails the run if any member gets a role their invite does not grant, or if fewer
+role invite joins get their role than ``--min-role-accuracy`` of those the invite fetches
+the bot made could tell apart at all.
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import typing
+
+import discord
+
+import database
+from bench.fake_discord import (FakeBot, FakeGateway, FakeGuild, FakeHTTP, FakeInteraction, FakeMember, FakeMessage,
+                                FakeUser)
+from clear import ClearCommands
+from rampage import RoleInvite
+
+DEFAULT_ROLE = 1
+ROLES = (10, 11, 12, 13)
+
+
+@dataclasses.dataclass
+class Join:
+    member: FakeMember
+    expected: typing.Optional[int]  # Role of the invite used, None for other invites
+    joined: float
+    code: typing.Optional[str] = None  # Invite used, None if the guild had none
+    screened: typing.Optional[float] = None
+
+
+def percentile(samples: list[float], fraction: float) -> typing.Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+class Harness:
+    """One fake bot with both cogs loaded, shared by the scenarios of a run."""
+
+    def __init__(self, http: FakeHTTP, gateway: FakeGateway):
+        self.http = http
+        self.gateway = gateway
+        self.bot = FakeBot(http, gateway)
+        self.role_invite = RoleInvite(self.bot)
+        self.clear = ClearCommands(self.bot)
+        self.admin = FakeUser(0, "admin")
+        self.role_invites: dict[str, int] = {}  # code: role, as created
+        gateway.cogs = [self.role_invite, self.clear]
+
+    async def start(self) -> None:
+        self.gateway.start()
+        await self.role_invite.cog_load()
+        await self.role_invite._startup_task
+
+    async def stop(self) -> None:
+        await self.gateway.drain()
+        self.clear.cog_unload()
+        await self.role_invite.cog_unload()
+        self.gateway.close()
+
+    async def add_guilds(self, count: int, role_invites: int) -> list[FakeGuild]:
+        """Guilds with a default role, ``role_invites`` role invites and one plain invite each."""
+        guilds = []
+        for _ in range(count):
+            guild = self.bot.add_guild((DEFAULT_ROLE, *ROLES))
+            await self.role_invite.guild_configs.set_default_roles(guild.id, [DEFAULT_ROLE])
+            for n in range(role_invites):
+                await self.create_role_invite(guild, ROLES[n % len(ROLES)])
+            await guild.system_channel.create_invite(inviter=self.admin)
+            guilds.append(guild)
+        await self.gateway.drain()
+        return guilds
+
+    async def create_role_invite(self, guild: FakeGuild, role_id: int, max_uses: int = 0) -> None:
+        """Create a role invite through /rinv create."""
+        interaction = FakeInteraction(self.bot, guild, guild.system_channel, self.admin)
+        codes = set(guild.invites_by_code)
+        await self.role_invite.create.callback(self.role_invite, interaction, guild.get_role(role_id), None, "0s",
+                                               max_uses)
+        if not interaction.sent[-1].startswith("Role Invite created"):
+            raise RuntimeError(interaction.sent[-1])
+        for code in guild.invites_by_code.keys() - codes:
+            self.role_invites[code] = role_id
+
+    def role_of(self, guild: FakeGuild, code: typing.Optional[str]) -> typing.Optional[int]:
+        return self.role_invites.get(code) if code else None
+
+    def join(self, guild: FakeGuild, role_share: float, pending: bool = False) -> Join:
+        """A member joins through a random live invite, a role invite with probability ``role_share``."""
+        codes = list(guild.invites_by_code)
+        role_codes = [code for code in codes if self.role_of(guild, code)]
+        other_codes = [code for code in codes if code not in role_codes]
+        if role_codes and (random.random() < role_share or not other_codes):
+            code = random.choice(role_codes)
+        else:
+            code = random.choice(other_codes) if other_codes else None
+        expected = self.role_of(guild, code)
+        return Join(guild.join(code, pending), expected, time.monotonic(), code)
+
+    async def settle(self, joins: list[Join], timeout: float) -> float:
+        """Wait until every member got their roles or ``timeout`` passes, return when the last one did."""
+        deadline = time.monotonic() + timeout
+        while any(join.member.roles_at is None for join in joins) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await self.gateway.drain()
+        return max((join.member.roles_at for join in joins if join.member.roles_at), default=time.monotonic())
+
+
+def attributable(joins: list[Join]) -> int:
+    """Role invite joins that the invite fetches made could tell apart, whatever the attribution.
+
+    A fetch counts the uses of every join before it, so the joins first counted by the same
+    fetch can only be attributed if none or all of them used the same role invite.
+    """
+    segments = collections.defaultdict(list)
+    for join in joins:
+        guild = join.member.guild
+        if (fetch := bisect.bisect(guild.fetched, join.joined)) < len(guild.fetched):
+            segments[(guild.id, fetch)].append(join)
+    return sum(sum(join.expected is not None for join in segment) for segment in segments.values()
+               if len({join.code if join.expected else None for join in segment}) == 1)
+
+
+def join_report(joins: list[Join], started: float, finished: float) -> dict[str, typing.Any]:
+    latencies = [join.member.roles_at - join.joined for join in joins
+                 if join.member.roles_at and join.screened is None]
+    screening = [join.member.roles_at - join.screened for join in joins
+                 if join.member.roles_at and join.screened is not None]
+    correct = role_correct = misattributed = unattributed = missing = 0
+    for join in joins:
+        roles = {role.id for role in join.member.roles}
+        invite_roles = roles - {DEFAULT_ROLE}
+        if DEFAULT_ROLE not in roles:
+            missing += 1
+        elif invite_roles == ({join.expected} if join.expected else set()):
+            correct += 1
+            role_correct += join.expected is not None
+        elif invite_roles:
+            misattributed += 1  # A role the member's invite does not grant
+        else:
+            unattributed += 1
+    took = finished - started
+    role_joins = sum(join.expected is not None for join in joins)
+    return {
+        "joins": len(joins),
+        "seconds": round(took, 2),
+        "joins_per_second": round(len(joins) / took, 1) if took > 0 else None,
+        "join_to_role_p50": percentile(latencies, 0.5),
+        "join_to_role_p99": percentile(latencies, 0.99),
+        "screening_to_role_p50": percentile(screening, 0.5),
+        "accuracy": round(correct / len(joins), 4) if joins else None,
+        "role_accuracy": round(role_correct / role_joins, 4) if role_joins else None,  # Of joins through role invites
+        "role_attributable": round(attributable(joins) / role_joins, 4) if role_joins else None,
+        "misattributed": misattributed,
+        "unattributed": unattributed,
+        "missing": missing,
+    }
+
+
+async def raid(harness: Harness, args: argparse.Namespace) -> dict[str, typing.Any]:
+    """Joins arrive as fast as ``--joins`` over ``--raid-seconds`` in several guilds at once."""
+    guilds = await harness.add_guilds(args.guilds, role_invites=3)
+    joins = []
+    started = time.monotonic()
+    for _ in range(args.joins):
+        joins.append(harness.join(random.choice(guilds), args.role_share))
+        await asyncio.sleep(args.raid_seconds / args.joins)
+    return join_report(joins, started, await harness.settle(joins, args.timeout))
+
+
+async def churn(harness: Harness, args: argparse.Namespace) -> dict[str, typing.Any]:
+    """Steady joins while role invites are created and revoked and plain invites come and go."""
+    guilds = await harness.add_guilds(max(args.guilds // 3, 1), role_invites=2)
+    joins = []
+    stop = asyncio.Event()
+
+    async def admins() -> None:
+        while not stop.is_set():
+            guild = random.choice(guilds)
+            action = random.random()
+            if action < 0.4:
+                await harness.create_role_invite(guild, random.choice(ROLES), max_uses=random.choice((0, 0, 3, 10)))
+            elif action < 0.6:
+                await guild.system_channel.create_invite(inviter=harness.admin)
+            elif len(guild.invites_by_code) > 2:
+                try:
+                    await harness.bot.delete_invite(random.choice(list(guild.invites_by_code)))
+                except discord.NotFound:
+                    pass
+            await asyncio.sleep(args.churn_interval)
+
+    churning = asyncio.create_task(admins())
+    started = time.monotonic()
+    for _ in range(args.joins):
+        joins.append(harness.join(random.choice(guilds), args.role_share))
+        await asyncio.sleep(args.churn_seconds / args.joins)
+    stop.set()
+    await churning
+    return join_report(joins, started, await harness.settle(joins, args.timeout))
+
+
+async def screening(harness: Harness, args: argparse.Namespace) -> dict[str, typing.Any]:
+    """Members join pending and complete membership screening a few seconds later."""
+    guilds = await harness.add_guilds(max(args.guilds // 3, 1), role_invites=2)
+    joins = []
+    started = time.monotonic()
+    for _ in range(args.joins // 2):
+        joins.append(harness.join(random.choice(guilds), args.role_share, pending=True))
+        await asyncio.sleep(args.raid_seconds / args.joins)
+    await asyncio.sleep(args.screening_delay)
+    for join in random.sample(joins, len(joins)):
+        join.screened = time.monotonic()
+        join.member.guild.complete_screening(join.member)
+        await asyncio.sleep(args.raid_seconds / args.joins)
+    return join_report(joins, started, await harness.settle(joins, args.timeout))
+
+
+async def clear(harness: Harness, args: argparse.Namespace) -> dict[str, typing.Any]:
+    """/clear filter over a long history, mostly young messages and some older than 14 days."""
+    guild = harness.bot.add_guild((DEFAULT_ROLE,))
+    channel = guild.system_channel
+    people = [harness.bot.user, *(FakeMember(guild, next(harness.bot.ids)) for _ in range(20))]
+    now = discord.utils.utcnow()
+    for n in range(args.messages):
+        age = (15 + random.random() * 30) * 86400 if n < args.old_messages else random.random() * 13 * 86400
+        message_id = discord.utils.time_snowflake(now - datetime.timedelta(seconds=age)) + n % 4096
+        channel.messages[message_id] = FakeMessage(channel, message_id, random.choice(people),
+                                                   f"message {n}", pinned=n % 97 == 0)
+    before = len(channel.messages)
+    interaction = FakeInteraction(harness.bot, guild, channel, harness.admin)
+    started = time.monotonic()
+    await harness.clear.filter_messages.callback(harness.clear, interaction, args.messages)
+    while harness.clear.jobs:
+        await asyncio.sleep(0.1)
+    took = time.monotonic() - started
+    deleted = before - len(channel.messages)
+    return {
+        "messages": before,
+        "deleted": deleted,
+        "seconds": round(took, 2),
+        "messages_per_second": round(deleted / took, 1) if took > 0 else None,
+        "final_status": interaction.edits[-1] if interaction.edits else None,
+    }
+
+
+SCENARIOS = {"raid": raid, "churn": churn, "screening": screening, "clear": clear}
+
+
+async def run(args: argparse.Namespace) -> dict[str, typing.Any]:
+    http = FakeHTTP(latency=args.http_latency, time_scale=args.time_scale)
+    harness = Harness(http, FakeGateway(latency=args.gateway_latency))
+    await harness.start()
+    results = {}
+    try:
+        for name in args.scenarios:
+            requests, rate_limited = http.requests.copy(), http.rate_limited.copy()
+            result = await SCENARIOS[name](harness, args)
+            result["rest_calls"] = dict(http.requests - requests)
+            result["rate_limited"] = dict(http.rate_limited - rate_limited)
+            results[name] = result
+            print_result(name, result)
+    finally:
+        await harness.stop()
+    return results
+
+
+def print_result(name: str, result: dict[str, typing.Any]) -> None:
+    print(f"{name}:")
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = ", ".join(f"{route} {count}" for route, count in sorted(value.items())) or "none"
+        elif isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"  {key:<22} {value}")
+
+
+def check_raid(result: dict[str, typing.Any], min_role_accuracy: float) -> typing.Optional[str]:
+    """Why the raid result is not good enough, or None."""
+    if result["misattributed"]:
+        return f"{result['misattributed']} members got a role their invite does not grant"
+    if result["role_accuracy"] is not None and \
+            result["role_accuracy"] < min_role_accuracy * result["role_attributable"]:
+        return (f"role invite accuracy {result['role_accuracy']:.3f} is below {min_role_accuracy:.0%} of the "
+                f"{result['role_attributable']:.3f} the invite fetches allowed")
+    return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS), help=", ".join(SCENARIOS))
+    parser.add_argument("--guilds", type=int, default=30)
+    parser.add_argument("--joins", type=int, default=300)
+    parser.add_argument("--role-share", type=float, default=0.8, help="Share of joins through role invites")
+    parser.add_argument("--raid-seconds", type=float, default=5.0)
+    parser.add_argument("--churn-seconds", type=float, default=20.0)
+    parser.add_argument("--churn-interval", type=float, default=0.5)
+    parser.add_argument("--screening-delay", type=float, default=3.0)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--old-messages", type=int, default=20)
+    parser.add_argument("--http-latency", type=float, default=0.05)
+    parser.add_argument("--gateway-latency", type=float, default=0.05)
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Factor applied to rate-limit windows")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-role-accuracy", type=float, default=0.8,
+                        help="Share of the attributable role invite joins the raid must attribute")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - SCENARIOS.keys():
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    random.seed(args.seed)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s | %(message)s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.DB_PATH = os.path.join(directory, "invites.db")
+        database.init_db()
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            database.close_db()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"args": vars(args), "results": results}, file, indent=2)
+    if "raid" in results and (problem := check_raid(results["raid"], args.min_role_accuracy)):
+        sys.exit(f"raid check failed: {problem}")
+
+
+if __name__ == "__main__":
+    main()
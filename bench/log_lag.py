@@ -0,0 +1,100 @@
+"""Event loop lag of logging during a join burst, with and without the queue log handler.
+
+``direct`` is the old setup, where the root logger wrote to the rotating log file and the
+stream directly from the event loop. ``queue`` and ``json`` go through ``logs.setup_logging``,
+which leaves formatting and writing to the listener thread. Every join logs the three lines the
+join path logs, and the stream goes to ``os.devnull`` so the terminal does not skew the result.
+
+    python -m bench.log_lag --joins 20000 --batch 100 --interval 0.01
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import tempfile
+import time
+import typing
+from logging.handlers import QueueListener, RotatingFileHandler
+
+from bench.db_join_path import LoopLag
+from logs import setup_logging
+from metrics import LOG_DROPPED
+
+MODES = ("direct", "queue", "json")
+
+
+def configure(mode: str, path: str, stream: typing.TextIO) -> typing.Optional[QueueListener]:
+    """Set up the root logger like the bot did before (``direct``) or does now, returning the listener."""
+    if mode != "direct":
+        with contextlib.redirect_stderr(stream):  # The stream handler picks up sys.stderr when created
+            return setup_logging(path, structured=mode == "json")
+    formatter = logging.Formatter('%(asctime)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    for handler in (RotatingFileHandler(path, maxBytes=5242880, backupCount=5, encoding='utf-8', mode='a'),
+                    logging.StreamHandler(stream)):
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    return None
+
+
+def reset() -> None:
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+
+async def burst(joins: int, batch: int, interval: float) -> float:
+    """Join ``batch`` members every ``interval`` seconds, returning the time the loop spent logging."""
+    spent = 0.0
+
+    async def join(n: int) -> None:
+        nonlocal spent
+        await asyncio.sleep(0)  # Where the handler awaited the invite fetch
+        guild_id, code = n % 50, f"inv{n % 20}"
+        started = time.perf_counter()
+        logging.info("Attributed %d of %d joins in %s to role invites.", 1, 1, f"guild{guild_id}",
+                     extra={"guild_id": guild_id})
+        logging.info("%s joined using invite %s for role %s.", f"user{n}", code, "role",
+                     extra={"guild_id": guild_id, "member_id": n, "invite": code})
+        logging.info("Assigned %s to %s.", "role", f"user{n}",
+                     extra={"guild_id": guild_id, "member_id": n, "latency": 0.25})
+        spent += time.perf_counter() - started
+
+    for start in range(0, joins, batch):
+        await asyncio.gather(*(join(n) for n in range(start, min(start + batch, joins))))
+        await asyncio.sleep(interval)
+    return spent
+
+
+async def run(mode: str, args: argparse.Namespace, directory: str) -> None:
+    dropped = LOG_DROPPED.value("INFO")
+    with open(os.devnull, "w") as stream:
+        listener = configure(mode, os.path.join(directory, f"{mode}.log"), stream)
+        try:
+            with LoopLag() as lag:
+                spent = await burst(args.joins, args.batch, args.interval)
+        finally:
+            if listener:
+                listener.stop()  # Until every queued record is written
+            reset()
+    print(f"{mode:>6}: {spent * 1000:.0f}ms on the loop in logging, {lag.summary()}, "
+          f"{LOG_DROPPED.value('INFO') - dropped:.0f} records dropped")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--joins", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=100, help="Joins arriving together")
+    parser.add_argument("--interval", type=float, default=0.01, help="Seconds between batches")
+    parser.add_argument("--mode", choices=MODES + ("all",), default="all")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in MODES if args.mode == "all" else (args.mode,):
+            asyncio.run(run(mode, args, directory))
+
+
+if __name__ == "__main__":
+    main()
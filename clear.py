@@ -1,18 +1,30 @@
-from time import sleep
+import re
+import time
+import typing
+from datetime import timedelta
 
 import discord.errors
-from discord import app_commands, Interaction, TextChannel, Member, DMChannel
+from discord import app_commands, Interaction, TextChannel, Member, DMChannel, Message
 from discord.ext import commands
 import asyncio
 
+from database import index_dm_message, load_dm_messages, delete_dm_messages
+from filters import MessageFilter
+from metrics import CLEAR_JOB, CLEAR_DELETED
+from utils import timer
+
 from discord.ext.commands import guild_only, dm_only
 
+# Deletes of the bot's own DM messages share a small per-channel bucket, more in flight only queue up
+DM_DELETE_CONCURRENCY = 2
+
 
 class ClearCommands(commands.Cog, name="clear"):
     """Clear Commands"""
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.jobs: dict[int, PurgeJob] = {}
 
     clear_commands = app_commands.Group(name="clear", description="Clear Commands", guild_only=True)
 
@@ -38,8 +50,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def default(self, interaction: Interaction, amount: int):
         """Delete Messages inside a Text Channel"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(interaction.channel, amount, lambda m: not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter())
 
     # Clear bot messages
     @clear_commands.command(name="bot", description="Delete Messages from Bots inside a Text Channel")
@@ -47,8 +58,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def bot(self, interaction: Interaction, amount: int):
         """Delete Messages from Bots"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(interaction.channel, amount, lambda m: m.author.bot and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(bot=True))
 
     # Clear messages from a specific member
     @clear_commands.command(name="member", description="Delete Messages from a specific Member")
@@ -56,8 +66,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def member(self, interaction: Interaction, user: Member, amount: int):
         """Delete Messages from a specific Member"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(interaction.channel, amount, lambda m: m.author == user and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(author=user.id))
 
     # Clear messages containing a specific word
     @clear_commands.command(name="contains", description="Delete Messages containing a specific word")
@@ -65,9 +74,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def contains(self, interaction: Interaction, word: str, amount: int):
         """Delete Messages which contain a specific word"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(
-                interaction.channel, amount, lambda m: word.lower() in m.content.lower() and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(contains=word))
 
     # Clear messages starting with a specific word
     @clear_commands.command(name="startswith", description="Delete Messages starting with a specific word")
@@ -75,9 +82,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def startswith(self, interaction: Interaction, word: str, amount: int):
         """Delete Messages that start with a specific word"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(
-                interaction.channel, amount, lambda m: m.content.lower().startswith(word.lower()) and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(startswith=word))
 
     # Clear messages with attachments
     @clear_commands.command(name="attachment", description="Delete Messages containing attachments")
@@ -85,8 +90,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def attachment(self, interaction: Interaction, amount: int):
         """Delete Messages containing attachments"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(interaction.channel, amount, lambda m: len(m.attachments) > 0 and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(attachments=True))
 
     # Clear messages with embeds
     @clear_commands.command(name="embeds", description="Delete Messages containing embeds")
@@ -94,8 +98,7 @@ class ClearCommands(commands.Cog, name="clear"):
     async def embeds(self, interaction: Interaction, amount: int):
         """Delete Messages containing embeds"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(interaction.channel, amount, lambda m: len(m.embeds) > 0 and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(embeds=True))
 
     # Clear messages containing mentions
     @clear_commands.command(name="mentions", description="Delete Messages containing mentions")
@@ -103,40 +106,234 @@ class ClearCommands(commands.Cog, name="clear"):
     async def mentions(self, interaction: Interaction, amount: int):
         """Delete Messages containing mentions"""
         if interaction.channel:
-            deleted = await bulk_delete_messages(
-                interaction.channel, amount, lambda m: (len(m.mentions) > 0 or len(m.channel_mentions) > 0 or len(m.role_mentions) > 0) and not m.pinned)
-            await clear_success_message(interaction, deleted)
+            await self.start_purge(interaction, amount, MessageFilter(mentions=True))
+
+    # Clear messages matching several criteria at once
+    @clear_commands.command(name="filter", description="Delete Messages matching all of the given criteria")
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.describe(
+        amount="Number of messages to search",
+        user="Only messages from this member",
+        bots="Only messages from bots (True) or from humans (False)",
+        contains="Only messages containing this text",
+        startswith="Only messages starting with this text",
+        regex="Only messages matching this regular expression",
+        attachments="Only messages with (True) or without (False) attachments",
+        embeds="Only messages with (True) or without (False) embeds",
+        mentions="Only messages with (True) or without (False) mentions",
+        newer_than="Only messages younger than this, e.g. 10m",
+        older_than="Only messages older than this, e.g. 2d"
+    )
+    async def filter_messages(
+            self,
+            interaction: Interaction,
+            amount: int,
+            user: typing.Optional[Member] = None,
+            bots: typing.Optional[bool] = None,
+            contains: typing.Optional[str] = None,
+            startswith: typing.Optional[str] = None,
+            regex: typing.Optional[str] = None,
+            attachments: typing.Optional[bool] = None,
+            embeds: typing.Optional[bool] = None,
+            mentions: typing.Optional[bool] = None,
+            newer_than: typing.Optional[str] = None,
+            older_than: typing.Optional[str] = None
+    ):
+        """Delete Messages matching all of the given criteria in a single pass"""
+        if not interaction.channel:
+            return
+        try:
+            message_filter = MessageFilter(
+                author=user.id if user else None, bot=bots, contains=contains, startswith=startswith, regex=regex,
+                attachments=attachments, embeds=embeds, mentions=mentions,
+                newer_than=timedelta(seconds=timer(newer_than)) if newer_than else None,
+                older_than=timedelta(seconds=timer(older_than)) if older_than else None
+            )
+        except (ValueError, re.error) as e:
+            await interaction.response.send_message(f"Invalid filter: {e}", ephemeral=True)
+            return
+        await self.start_purge(interaction, amount, message_filter)
 
     # # DM clear command
     @app_commands.command(name="dm", description="Delete Bot Messages in Private DM Channels")
     @app_commands.dm_only()
     async def dm(self, interaction: Interaction):
         """Delete Bot Messages in Private DM Channels"""
-        if isinstance(interaction.channel, DMChannel):
-            async for msg in interaction.channel.history(limit=500):
+        if not isinstance(interaction.channel, DMChannel):
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        channel = interaction.channel
+        message_ids, scan_before = await load_dm_messages(channel.id)
+        pinned = {message.id for message in await channel.pins()}
+        to_delete = [message_id for message_id in message_ids if message_id not in pinned]
+        if scan_before != 0:
+            # Messages sent before the index existed can only be found in the history, once
+            before = discord.Object(scan_before) if scan_before else None
+            async for msg in channel.history(limit=None, before=before):
                 if msg.author == self.bot.user and not msg.pinned:
-                    await msg.delete()
-
-async def bulk_delete_messages(channel, amount, check):
-    """Helper function to delete messages matching a condition."""
-    try:
-        delete = await channel.purge(check=check, limit=amount, bulk=True)
-        # sleep(1)
-        return len(delete)
-    except discord.errors.NotFound:
-        return None
-    except discord.errors.RateLimited:
-        pass
-
-async def clear_success_message(interaction: Interaction, count: int):
-    """Helper function to send a success message after clearing messages."""
-    # noinspection PyBroadException
-    try:
-        await interaction.response.send_message(f"Deleted {count} messages.", ephemeral=True)
-    except discord.errors.NotFound:
-        return
-    except Exception:
-        pass
+                    to_delete.append(msg.id)
+
+        semaphore = asyncio.Semaphore(DM_DELETE_CONCURRENCY)
+        results = await asyncio.gather(
+            *(self._delete_dm_message(channel.get_partial_message(message_id), semaphore) for message_id in to_delete))
+        # Failed deletes stay indexed, and an unfinished history scan is repeated by the next /dm
+        gone = [message_id for message_id, result in zip(to_delete, results) if result is not None]
+        await delete_dm_messages(channel.id, gone, scanned=len(gone) == len(to_delete))
+        deleted = results.count(True)
+        CLEAR_DELETED.inc("dm", amount=deleted)
+        failed = len(to_delete) - len(gone)
+        note = f" {failed} could not be deleted, run /dm again to retry." if failed else ""
+        await interaction.followup.send(f"Deleted {deleted} messages.{note}", ephemeral=True)
+
+    @staticmethod
+    async def _delete_dm_message(message: discord.PartialMessage, semaphore: asyncio.Semaphore) -> typing.Optional[bool]:
+        """Delete a message, returning False if it was already gone and None if the delete failed."""
+        async with semaphore:
+            try:
+                await message.delete()
+                return True
+            except discord.NotFound:
+                return False
+            except discord.HTTPException:
+                return None
+
+    @commands.Cog.listener()
+    async def on_message(self, message: Message):
+        """Index the messages the bot sends in DM channels for /dm."""
+        if message.author == self.bot.user and isinstance(message.channel, DMChannel):
+            await index_dm_message(message.channel.id, message.id)
+
+    async def start_purge(self, interaction: Interaction, amount: int, message_filter: MessageFilter):
+        """Start a background job deleting matching messages among the last ``amount`` of the channel."""
+        channel_id = interaction.channel.id
+        if channel_id in self.jobs:
+            await interaction.response.send_message("A clear job is already running in this channel.", ephemeral=True)
+            return
+        job = self.jobs[channel_id] = PurgeJob(interaction, amount, message_filter)
+        await interaction.response.send_message("Clearing messages...", view=job.view, ephemeral=True)
+        job.start().add_done_callback(lambda _: self.jobs.pop(channel_id, None))
+
+    def cog_unload(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+
+
+class PurgeView(discord.ui.View):
+    """Cancel button shown on a running clear job."""
+
+    def __init__(self, job: "PurgeJob"):
+        super().__init__(timeout=None)
+        self.job = job
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
+    async def cancel(self, interaction: Interaction, button: discord.ui.Button):
+        self.job.cancel()
+        await interaction.response.defer()
+
+
+class PurgeJob:
+    """Streams a channel's history and deletes the matching messages in the background.
+
+    Messages young enough for the bulk endpoint are deleted 100 at a time as soon as a chunk
+    fills, older ones go to a single-delete lane running in parallel, and progress is shown
+    by editing the original response.
+    """
+
+    CHUNK_SIZE = 100
+    PROGRESS_INTERVAL = 2.0
+
+    def __init__(self, interaction: Interaction, amount: int, message_filter: MessageFilter):
+        self.interaction = interaction
+        self.channel = interaction.channel
+        self.amount = amount
+        self.message_filter = message_filter
+        self.view = PurgeView(self)
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self._old: asyncio.Queue[typing.Optional[Message]] = asyncio.Queue()
+        self._task: typing.Optional[asyncio.Task] = None
+        self._last_report = 0.0
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    def cancel(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def run(self) -> None:
+        # The bulk endpoint rejects messages older than 14 days, keep a minute of slack
+        bulk_cutoff = discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(days=14, minutes=-1))
+        single_lane = asyncio.create_task(self._delete_old())
+        status = "Deleted"
+        started = time.perf_counter()
+        try:
+            chunk = []
+            async for message in self.channel.history(limit=self.amount):
+                if message.id < self.message_filter.min_id:
+                    break  # History is newest first, nothing older can match
+                self.scanned += 1
+                if self.message_filter.check(message):
+                    self.matched += 1
+                    if message.id < bulk_cutoff:
+                        self._old.put_nowait(message)
+                    else:
+                        chunk.append(message)
+                        if len(chunk) == self.CHUNK_SIZE:
+                            await self._delete_bulk(chunk)
+                            chunk = []
+                await self._report()
+            if chunk:
+                await self._delete_bulk(chunk)
+            self._old.put_nowait(None)
+            await single_lane
+        except asyncio.CancelledError:
+            status = "Cancelled after deleting"
+        except discord.HTTPException as e:
+            status = f"Failed ({e.text or e.status}) after deleting"
+        finally:
+            single_lane.cancel()
+            CLEAR_JOB.observe(time.perf_counter() - started)
+            await self._report(f"{status} {self.deleted} messages.", final=True)
+
+    async def _delete_bulk(self, messages: list[Message]) -> None:
+        while True:
+            try:
+                await self.channel.delete_messages(messages)
+                self.deleted += len(messages)
+                CLEAR_DELETED.inc("bulk", amount=len(messages))
+                break
+            except discord.RateLimited as e:
+                await asyncio.sleep(e.retry_after)
+            except discord.NotFound:
+                break  # Already deleted, e.g. by someone else
+
+    async def _delete_old(self) -> None:
+        while (message := await self._old.get()) is not None:
+            while True:
+                try:
+                    await message.delete()
+                    self.deleted += 1
+                    CLEAR_DELETED.inc("single")
+                    break
+                except discord.RateLimited as e:
+                    await asyncio.sleep(e.retry_after)
+                except discord.NotFound:
+                    break
+            await self._report()
+
+    async def _report(self, content: typing.Optional[str] = None, final: bool = False) -> None:
+        now = time.monotonic()
+        if not final and now - self._last_report < self.PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        content = content or f"Deleted {self.deleted} of {self.matched} matching messages ({self.scanned} scanned)..."
+        try:
+            await self.interaction.edit_original_response(content=content, view=None if final else self.view)
+        except discord.HTTPException:
+            pass  # The interaction token expires after 15 minutes, the job keeps running regardless
 
 async def clear_check(interaction: Interaction, amount: int, limit: int) -> bool:
     """Check if the amount of messages to delete is within the allowed limit."""
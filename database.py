@@ -0,0 +1,423 @@
+"""SQLite storage for role invites and default roles.
+
+Every query runs on one long-lived connection that is owned by a dedicated worker
+thread, so no database I/O ever blocks the event loop. In sharded mode every worker
+process has its own connection, WAL lets them read concurrently while writers take
+turns, waiting up to ``BUSY_TIMEOUT`` seconds for the write lock.
+"""
+import asyncio
+import functools
+import logging
+import sqlite3
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_QUERY
+
+DB_PATH = "invites.db"
+BUSY_TIMEOUT = 30.0
+# Bucket lengths of the attribution rollups, in seconds
+HOUR = 3600
+DAY = 86400
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="invites-db")
+_conn: typing.Optional[sqlite3.Connection] = None
+
+
+def _connection() -> sqlite3.Connection:
+    """Return the shared connection, opening it in WAL mode on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False, cached_statements=256)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+    return _conn
+
+
+def _call(func, args, kwargs):
+    return func(_connection(), *args, **kwargs)
+
+
+def db_thread(func):
+    """Turn a query function taking the connection into a coroutine run on the database thread."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        with DB_QUERY.time(func.__name__):
+            return await loop.run_in_executor(_executor, _call, func, args, kwargs)
+    return wrapper
+
+
+# Each entry migrates the schema from the version at its index to the next one. Never edit a
+# released migration, append a new one instead.
+MIGRATIONS: list[list[str]] = [
+    # 1: the original schema, a no-op for databases created before versioning existed
+    [
+        '''CREATE TABLE IF NOT EXISTS invites (
+            _id INTEGER PRIMARY KEY,
+            invite_id TEXT UNIQUE,
+            guild_id TEXT,
+            role_id INTEGER,
+            inviter INTEGER,
+            uses INTEGER DEFAULT 0,
+            max_uses INTEGER,
+            duration INTEGER,
+            channel_id INTEGER
+        )''',
+        '''CREATE TABLE IF NOT EXISTS default_roles (
+            guild_id TEXT PRIMARY KEY,
+            role_id INTEGER
+        )''',
+    ],
+    # 2: native INTEGER snowflakes and indexes for the per-guild queries
+    [
+        '''CREATE TABLE invites_v2 (
+            _id INTEGER PRIMARY KEY,
+            invite_id TEXT NOT NULL UNIQUE,
+            guild_id INTEGER NOT NULL,
+            role_id INTEGER,
+            inviter INTEGER,
+            uses INTEGER DEFAULT 0,
+            max_uses INTEGER,
+            duration INTEGER,
+            channel_id INTEGER
+        )''',
+        '''INSERT INTO invites_v2 SELECT _id, invite_id, CAST(guild_id AS INTEGER), role_id, inviter, uses, max_uses,
+           duration, channel_id FROM invites WHERE invite_id IS NOT NULL AND guild_id IS NOT NULL''',
+        "DROP TABLE invites",
+        "ALTER TABLE invites_v2 RENAME TO invites",
+        "CREATE INDEX idx_invites_guild ON invites (guild_id, invite_id)",
+        # Covers load_role_invites without touching the table
+        "CREATE INDEX idx_invites_roles ON invites (guild_id, invite_id, role_id, uses) WHERE role_id",
+        '''CREATE TABLE default_roles_v2 (
+            guild_id INTEGER PRIMARY KEY,
+            role_id INTEGER NOT NULL
+        )''',
+        '''INSERT INTO default_roles_v2 SELECT CAST(guild_id AS INTEGER), role_id FROM default_roles
+           WHERE role_id IS NOT NULL''',
+        "DROP TABLE default_roles",
+        "ALTER TABLE default_roles_v2 RENAME TO default_roles",
+    ],
+    # 3: members still in membership screening and the invite they joined through
+    [
+        '''CREATE TABLE pending_members (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            invite_id TEXT,
+            joined_at REAL NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        ) WITHOUT ROWID''',
+        "CREATE INDEX idx_pending_members_joined ON pending_members (joined_at)",
+    ],
+    # 4: messages the bot sent in DM channels, so /dm needs no history scan
+    [
+        '''CREATE TABLE dm_messages (
+            channel_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID''',
+        # Messages older than scan_before were sent before indexing began, 0 once they were scanned
+        '''CREATE TABLE dm_channels (
+            channel_id INTEGER PRIMARY KEY,
+            scan_before INTEGER NOT NULL
+        )''',
+    ],
+    # 5: bot wide key-value state, like the hash of the last synced command tree
+    [
+        '''CREATE TABLE settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID''',
+    ],
+    # 6: any number of default roles per guild
+    [
+        '''CREATE TABLE guild_default_roles (
+            guild_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, role_id)
+        ) WITHOUT ROWID''',
+        "INSERT INTO guild_default_roles SELECT guild_id, role_id FROM default_roles WHERE role_id",
+        "DROP TABLE default_roles",
+    ],
+    # 7: when invites created by the bot expire, so they are revoked on time instead of polled for
+    [
+        "ALTER TABLE invites ADD COLUMN expires_at REAL",
+    ],
+    # 8: append-only log of attributed joins and its hourly and daily join counts per invite
+    [
+        '''CREATE TABLE attributions (
+            _id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            invite_id TEXT NOT NULL,
+            role_id INTEGER,
+            inviter INTEGER,
+            joined_at REAL NOT NULL
+        )''',
+        '''CREATE TABLE attribution_rollups (
+            guild_id INTEGER NOT NULL,
+            period INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            invite_id TEXT NOT NULL,
+            inviter INTEGER,
+            joins INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, period, bucket, invite_id)
+        ) WITHOUT ROWID''',
+    ],
+]
+
+
+def _init_db(conn: sqlite3.Connection) -> None:
+    """Bring the database up to the latest schema version, one transaction per migration.
+
+    The version is read under the write lock, so processes starting at the same time
+    never apply a migration twice.
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    while True:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT version FROM schema_version").fetchone()
+            version = row[0] if row else 0
+            if version >= len(MIGRATIONS):
+                return
+            for statement in MIGRATIONS[version]:
+                conn.execute(statement)
+            conn.execute("DELETE FROM schema_version")
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version + 1,))
+        logging.info(f"Migrated {DB_PATH} to schema version {version + 1}.")
+
+
+def init_db() -> None:
+    _executor.submit(_call, _init_db, (), {}).result()
+
+
+def _close_db(conn: sqlite3.Connection) -> None:
+    global _conn
+    conn.close()
+    _conn = None
+
+
+def close_db() -> None:
+    """Close the shared connection and stop the database thread."""
+    if _conn is not None:
+        _executor.submit(_call, _close_db, (), {}).result()
+    _executor.shutdown(wait=True)
+
+
+@db_thread
+def load_invite_page(conn: sqlite3.Connection, guild_id: int, limit: int, after: typing.Optional[str] = None,
+                     before: typing.Optional[str] = None) -> list[tuple[str, int, int, int]]:
+    """Keyset-paginate a guild's invites by ``invite_id``, returning ``(invite_id, role_id, uses, max_uses)``.
+
+    Pages after ``after`` come in ascending order, pages before ``before`` in descending order.
+    """
+    if before is not None:
+        return conn.execute("SELECT invite_id, role_id, uses, max_uses FROM invites "
+                            "WHERE guild_id = ? AND invite_id < ? ORDER BY invite_id DESC LIMIT ?",
+                            (guild_id, before, limit)).fetchall()
+    return conn.execute("SELECT invite_id, role_id, uses, max_uses FROM invites "
+                        "WHERE guild_id = ? AND invite_id > ? ORDER BY invite_id LIMIT ?",
+                        (guild_id, after or "", limit)).fetchall()
+
+
+@db_thread
+def load_role_invites(conn: sqlite3.Connection) -> list[tuple[int, str, int, int]]:
+    """Return ``(guild_id, invite_id, role_id, uses)`` for every invite that grants a role."""
+    return conn.execute("SELECT guild_id, invite_id, role_id, uses FROM invites WHERE role_id").fetchall()
+
+
+@db_thread
+def load_invite_limits(conn: sqlite3.Connection) -> list[tuple[int, str, int, int, typing.Optional[float]]]:
+    """Return ``(guild_id, invite_id, uses, max_uses, expires_at)`` for role invites with a use or time limit."""
+    return conn.execute("SELECT guild_id, invite_id, uses, max_uses, expires_at FROM invites "
+                        "WHERE role_id AND (max_uses > 0 OR expires_at IS NOT NULL)").fetchall()
+
+
+@db_thread
+def save_invite(conn: sqlite3.Connection, invite_id: str, guild_id: int, role_id: int, inviter: int, uses: int,
+                max_uses: int, duration: int, channel_id: int, expires_at: typing.Optional[float] = None) -> None:
+    with conn:
+        conn.execute('''INSERT OR REPLACE INTO invites (invite_id, guild_id, role_id, inviter, uses, max_uses,
+                    duration, channel_id, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (invite_id, guild_id, role_id, inviter, uses, max_uses, duration, channel_id, expires_at))
+
+
+@db_thread
+def reconcile_invites(conn: sqlite3.Connection, guild_id: int, invites: list[tuple]) -> tuple[int, int, list[str]]:
+    """Sync a guild's stored invites with the fetched ones using set-based SQL in one transaction.
+
+    ``invites`` holds ``(invite_id, inviter, uses, max_uses, channel_id)`` rows. Missing invites
+    are inserted without a role, use counts of invites without a role follow the server, and
+    stored invites that are gone are deleted. Returns the inserted and updated counts and
+    the deleted invite IDs.
+    """
+    conn.execute('''CREATE TEMP TABLE IF NOT EXISTS fetched_invites (
+        invite_id TEXT PRIMARY KEY,
+        inviter INTEGER,
+        uses INTEGER,
+        max_uses INTEGER,
+        channel_id INTEGER
+    )''')
+    with conn:
+        conn.execute("DELETE FROM fetched_invites")
+        conn.executemany("INSERT OR REPLACE INTO fetched_invites VALUES (?, ?, ?, ?, ?)", invites)
+        added = conn.execute('''INSERT INTO invites (invite_id, guild_id, role_id, inviter, uses, max_uses, duration,
+                             channel_id)
+                             SELECT invite_id, ?, NULL, inviter, uses, max_uses, NULL, channel_id FROM fetched_invites
+                             WHERE invite_id NOT IN (SELECT invite_id FROM invites)''', (guild_id,)).rowcount
+        updated = conn.execute('''UPDATE invites SET uses = fetched.uses FROM fetched_invites AS fetched
+                               WHERE invites.invite_id = fetched.invite_id AND COALESCE(invites.role_id, 0) = 0
+                               AND invites.uses IS NOT fetched.uses''').rowcount
+        deleted = [row[0] for row in conn.execute(
+            '''DELETE FROM invites WHERE guild_id = ? AND invite_id NOT IN (SELECT invite_id FROM fetched_invites)
+            RETURNING invite_id''', (guild_id,))]
+    return added, updated, deleted
+
+
+@db_thread
+def apply_invite_writes(conn: sqlite3.Connection, deleted: list[str],
+                        records: list[tuple[str, int, typing.Optional[int], int, int]],
+                        increments: list[tuple[int, str]],
+                        attributions: list[tuple[int, int, str, int, float]] = ()) -> None:
+    """Apply buffered invite writes in one transaction.
+
+    ``attributions`` are ``(guild_id, user_id, invite_id, role_id, joined_at)`` rows, they are
+    logged before the deletes so the inviter of an invite revoked in the same batch is kept.
+    The hourly and daily rollups are updated from the newly logged rows, the write lock is
+    taken before reading the last logged row so rows other processes log meanwhile are not
+    rolled up a second time.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if attributions:
+            last_id = conn.execute("SELECT COALESCE(MAX(_id), 0) FROM attributions").fetchone()[0]
+            conn.executemany('''INSERT INTO attributions (guild_id, user_id, invite_id, role_id, inviter, joined_at)
+                             VALUES (?1, ?2, ?3, ?4, (SELECT inviter FROM invites WHERE invite_id = ?3), ?5)''',
+                             attributions)
+            for period in (HOUR, DAY):
+                conn.execute('''INSERT INTO attribution_rollups (guild_id, period, bucket, invite_id, inviter, joins)
+                             SELECT guild_id, ?1, CAST(joined_at / ?1 AS INTEGER) * ?1, invite_id, inviter, COUNT(*)
+                             FROM attributions WHERE _id > ?2 GROUP BY 1, 2, 3, 4
+                             ON CONFLICT DO UPDATE SET joins = joins + excluded.joins''', (period, last_id))
+        conn.executemany("DELETE FROM invites WHERE invite_id = ?", [(invite_id,) for invite_id in deleted])
+        conn.executemany('''INSERT INTO invites (invite_id, guild_id, role_id, inviter, uses, max_uses, duration,
+                         channel_id) VALUES (?, ?, 0, ?, ?, ?, 0, 0)
+                         ON CONFLICT(invite_id) DO UPDATE SET uses = MAX(uses, excluded.uses)''', records)
+        conn.executemany("UPDATE invites SET uses = uses + ? WHERE invite_id = ?", increments)
+
+
+@db_thread
+def load_attribution_stats(conn: sqlite3.Connection, guild_id: int, period: int, since: float, group_by: str,
+                           invite_id: typing.Optional[str] = None, inviter: typing.Optional[int] = None,
+                           limit: int = 5) -> list[tuple[typing.Union[str, int, None], int]]:
+    """Sum the ``period`` rollups of a guild since ``since``, top ``limit`` per ``invite_id`` or ``inviter``.
+
+    Only rollup rows are read, so the cost depends on the window and the number of invites,
+    never on the number of joins.
+    """
+    if group_by not in ("invite_id", "inviter"):
+        raise ValueError(f"Cannot group attribution stats by {group_by}")
+    return conn.execute(f"SELECT {group_by}, SUM(joins) FROM attribution_rollups "
+                        "WHERE guild_id = ?1 AND period = ?2 AND bucket >= ?3 "
+                        "AND (?4 IS NULL OR invite_id = ?4) AND (?5 IS NULL OR inviter = ?5) "
+                        f"GROUP BY {group_by} ORDER BY 2 DESC LIMIT ?6",
+                        (guild_id, period, period * int(since // period), invite_id, inviter, limit)).fetchall()
+
+
+@db_thread
+def count_attributed_joins(conn: sqlite3.Connection, guild_id: int, period: int, since: float,
+                           invite_id: typing.Optional[str] = None, inviter: typing.Optional[int] = None) -> int:
+    """Total joins in the ``period`` rollups of a guild since ``since``, over every invite that matches."""
+    return conn.execute("SELECT COALESCE(SUM(joins), 0) FROM attribution_rollups "
+                        "WHERE guild_id = ?1 AND period = ?2 AND bucket >= ?3 "
+                        "AND (?4 IS NULL OR invite_id = ?4) AND (?5 IS NULL OR inviter = ?5)",
+                        (guild_id, period, period * int(since // period), invite_id, inviter)).fetchone()[0]
+
+
+@db_thread
+def update_invite_uses(conn: sqlite3.Connection, invite_id: str, uses: int) -> None:
+    with conn:
+        conn.execute("UPDATE invites SET uses = ? WHERE invite_id = ?", (uses, invite_id))
+
+
+@db_thread
+def load_default_roles(conn: sqlite3.Connection) -> list[tuple[int, int]]:
+    """Return ``(guild_id, role_id)`` for every default role, grouped by guild."""
+    return conn.execute("SELECT guild_id, role_id FROM guild_default_roles").fetchall()
+
+
+@db_thread
+def set_default_roles(conn: sqlite3.Connection, guild_id: int, role_ids: list[int]) -> None:
+    """Replace the default roles of a guild, an empty list removes them."""
+    with conn:
+        conn.execute("DELETE FROM guild_default_roles WHERE guild_id = ?", (guild_id,))
+        conn.executemany("INSERT INTO guild_default_roles (guild_id, role_id) VALUES (?, ?)",
+                         [(guild_id, role_id) for role_id in role_ids])
+
+
+@db_thread
+def get_setting(conn: sqlite3.Connection, key: str) -> typing.Optional[str]:
+    result = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return result[0] if result else None
+
+
+@db_thread
+def set_setting(conn: sqlite3.Connection, key: str, value: str) -> None:
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+
+@db_thread
+def load_pending_members(conn: sqlite3.Connection, cutoff: float) -> list[tuple[int, int, str, float]]:
+    """Drop pending members that joined before ``cutoff`` and return the rest, oldest first."""
+    with conn:
+        conn.execute("DELETE FROM pending_members WHERE joined_at < ?", (cutoff,))
+    return conn.execute("SELECT guild_id, user_id, invite_id, joined_at FROM pending_members "
+                        "ORDER BY joined_at").fetchall()
+
+
+@db_thread
+def save_pending_member(conn: sqlite3.Connection, guild_id: int, user_id: int, invite_id: typing.Optional[str],
+                        joined_at: float) -> None:
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO pending_members (guild_id, user_id, invite_id, joined_at) "
+                     "VALUES (?, ?, ?, ?)", (guild_id, user_id, invite_id, joined_at))
+
+
+@db_thread
+def delete_pending_member(conn: sqlite3.Connection, guild_id: int, user_id: int) -> None:
+    with conn:
+        conn.execute("DELETE FROM pending_members WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+
+
+@db_thread
+def purge_pending_members(conn: sqlite3.Connection, cutoff: float) -> None:
+    with conn:
+        conn.execute("DELETE FROM pending_members WHERE joined_at < ?", (cutoff,))
+
+
+@db_thread
+def index_dm_message(conn: sqlite3.Connection, channel_id: int, message_id: int) -> None:
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO dm_channels (channel_id, scan_before) VALUES (?, ?)", (channel_id, message_id))
+        conn.execute("INSERT OR IGNORE INTO dm_messages (channel_id, message_id) VALUES (?, ?)", (channel_id, message_id))
+
+
+@db_thread
+def load_dm_messages(conn: sqlite3.Connection, channel_id: int) -> tuple[list[int], typing.Optional[int]]:
+    """Return the indexed message IDs of a DM channel and its ``scan_before`` marker, None if never indexed."""
+    message_ids = [row[0] for row in conn.execute("SELECT message_id FROM dm_messages WHERE channel_id = ?",
+                                                  (channel_id,))]
+    row = conn.execute("SELECT scan_before FROM dm_channels WHERE channel_id = ?", (channel_id,)).fetchone()
+    return message_ids, row[0] if row else None
+
+
+@db_thread
+def delete_dm_messages(conn: sqlite3.Connection, channel_id: int, message_ids: list[int], scanned: bool) -> None:
+    """Drop deleted messages from the index, marking the channel's older history as scanned if ``scanned``."""
+    with conn:
+        conn.executemany("DELETE FROM dm_messages WHERE channel_id = ? AND message_id = ?",
+                         ((channel_id, message_id) for message_id in message_ids))
+        if scanned:
+            conn.execute("INSERT OR REPLACE INTO dm_channels (channel_id, scan_before) VALUES (?, 0)", (channel_id,))
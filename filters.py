@@ -0,0 +1,74 @@
+"""Composable message filters for the clear commands."""
+import re
+import typing
+from datetime import timedelta
+
+import discord
+from discord import Message
+
+
+class MessageFilter:
+    """A combined message predicate, compiled once from several optional criteria.
+
+    Every criterion left as ``None`` is ignored. The remaining ones are joined into the
+    source of a single lambda, cheapest first, so matching a message costs one call with
+    no per-criterion overhead. User input only ever ends up in the lambda's namespace,
+    never in its source. Pinned messages never match unless ``pinned`` is set.
+    """
+
+    def __init__(
+            self,
+            author: typing.Optional[int] = None,
+            bot: typing.Optional[bool] = None,
+            contains: typing.Optional[str] = None,
+            startswith: typing.Optional[str] = None,
+            regex: typing.Optional[str] = None,
+            attachments: typing.Optional[bool] = None,
+            embeds: typing.Optional[bool] = None,
+            mentions: typing.Optional[bool] = None,
+            newer_than: typing.Optional[timedelta] = None,
+            older_than: typing.Optional[timedelta] = None,
+            pinned: bool = False
+    ):
+        namespace: dict[str, typing.Any] = {}
+        expressions: list[str] = []
+        if not pinned:
+            expressions.append("not m.pinned")
+        if author is not None:
+            namespace["author"] = author
+            expressions.append("m.author.id == author")
+        if bot is not None:
+            expressions.append("m.author.bot" if bot else "not m.author.bot")
+        if attachments is not None:
+            expressions.append("m.attachments" if attachments else "not m.attachments")
+        if embeds is not None:
+            expressions.append("m.embeds" if embeds else "not m.embeds")
+        if mentions is not None:
+            expression = "(m.mentions or m.channel_mentions or m.role_mentions)"
+            expressions.append(expression if mentions else f"not {expression}")
+
+        # Snowflakes grow with time, so the age window is two integer comparisons
+        now = discord.utils.utcnow()
+        self.min_id = discord.utils.time_snowflake(now - newer_than) if newer_than is not None else 0
+        if self.min_id:
+            namespace["min_id"] = self.min_id
+            expressions.append("m.id >= min_id")
+        if older_than is not None:
+            namespace["max_id"] = discord.utils.time_snowflake(now - older_than, high=True)
+            expressions.append("m.id <= max_id")
+
+        if startswith:
+            namespace["prefix"] = startswith.lower()
+            expressions.append(f"m.content[:{len(startswith)}].lower() == prefix")
+        if contains:
+            namespace["word"] = contains.lower()
+            expressions.append("word in m.content.lower()")
+        if regex:
+            namespace["search"] = re.compile(regex).search
+            expressions.append("search(m.content) is not None")
+
+        source = f"lambda m: {' and '.join(expressions) or 'True'}"
+        self.check: typing.Callable[[Message], typing.Any] = eval(source, namespace)
+
+    def __call__(self, message: Message) -> bool:
+        return bool(self.check(message))
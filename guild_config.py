@@ -0,0 +1,38 @@
+"""In-memory per-guild configuration, so the join path never reads it from the database."""
+import typing
+
+from database import load_default_roles, set_default_roles
+
+
+class GuildConfig:
+    """Settings of one guild. Instances are never mutated, a write replaces the guild's config."""
+
+    __slots__ = ("default_roles",)
+
+    def __init__(self, default_roles: typing.Iterable[int] = ()):
+        self.default_roles: tuple[int, ...] = tuple(default_roles)
+
+
+class GuildConfigCache:
+    """Configuration of every guild, preloaded once and written through to the database."""
+
+    EMPTY = GuildConfig()
+
+    def __init__(self):
+        self._configs: dict[int, GuildConfig] = {}
+
+    def get(self, guild_id: int) -> GuildConfig:
+        return self._configs.get(guild_id, self.EMPTY)
+
+    async def load(self, owns_guild: typing.Callable[[int], bool] = lambda guild_id: True) -> None:
+        """Load the configuration of every guild ``owns_guild`` accepts."""
+        default_roles: dict[int, list[int]] = {}
+        for guild_id, role_id in await load_default_roles():
+            if owns_guild(guild_id):
+                default_roles.setdefault(guild_id, []).append(role_id)
+        self._configs = {guild_id: GuildConfig(role_ids) for guild_id, role_ids in default_roles.items()}
+
+    async def set_default_roles(self, guild_id: int, role_ids: typing.Iterable[int]) -> None:
+        role_ids = list(dict.fromkeys(role_ids))
+        await set_default_roles(guild_id, role_ids)
+        self._configs[guild_id] = GuildConfig(role_ids)
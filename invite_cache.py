@@ -0,0 +1,126 @@
+"""In-memory snapshot of role invite use counts per guild."""
+import collections
+import itertools
+import math
+import typing
+
+import discord
+
+MAX_SPLITS = 256  # Splits of the uncertain joins ``attribute`` tries before treating the fetches as one
+AMBIGUOUS = object()
+
+
+class InviteCache:
+    """Last seen use count of every role invite, keyed by guild.
+
+    Only role invites matter for attribution, so other invites are never stored and
+    guilds without role invites need no invite fetch at all when a member joins.
+    """
+
+    def __init__(self):
+        self._roles: dict[int, dict[str, int]] = {}
+        self._uses: dict[int, dict[str, int]] = {}
+        self._invalid: set[int] = set()
+
+    def has_role_invites(self, guild_id: int) -> bool:
+        return bool(self._roles.get(guild_id))
+
+    def role_for(self, guild_id: int, code: str) -> typing.Optional[int]:
+        return self._roles.get(guild_id, {}).get(code)
+
+    def track(self, guild_id: int, code: str, role_id: int, uses: int = 0) -> None:
+        """Register a role invite, keeping its count if the gateway already reported it."""
+        self._roles.setdefault(guild_id, {})[code] = role_id
+        self._uses.setdefault(guild_id, {}).setdefault(code, uses)
+
+    def set_uses(self, guild_id: int, code: str, uses: int) -> None:
+        """Raise the tracked count, an event carrying an older count must not undo a later fetch."""
+        if code in self._roles.get(guild_id, {}):
+            self._uses[guild_id][code] = max(self._uses[guild_id].get(code, 0), uses)
+
+    def forget(self, guild_id: int, code: str) -> None:
+        self._roles.get(guild_id, {}).pop(code, None)
+        self._uses.get(guild_id, {}).pop(code, None)
+
+    def drop_guild(self, guild_id: int) -> None:
+        self._roles.pop(guild_id, None)
+        self._uses.pop(guild_id, None)
+        self._invalid.discard(guild_id)
+
+    def clear(self) -> None:
+        self._roles.clear()
+        self._uses.clear()
+        self._invalid.clear()
+
+    def invalidate(self, guild_id: int) -> None:
+        """Make the next ``update`` reseed the snapshot, its uses may belong to joins that were already served."""
+        self._invalid.add(guild_id)
+
+    def seed(self, guild_id: int, invites: typing.Iterable[discord.Invite]) -> None:
+        """Overwrite the tracked counts with freshly fetched invites."""
+        roles = self._roles.get(guild_id, {})
+        snapshot = self._uses.setdefault(guild_id, {})
+        for invite in invites:
+            if invite.code in roles:
+                snapshot[invite.code] = invite.uses or 0
+
+    def update(self, guild_id: int, invites: typing.Iterable[discord.Invite]) -> typing.Optional[dict[str, int]]:
+        """Diff fetched invites against the snapshot, store the new counts and return the increments.
+
+        Returns None instead after ``invalidate``, the fetch only reseeds the snapshot then.
+        """
+        if guild_id in self._invalid:
+            self._invalid.discard(guild_id)
+            self.seed(guild_id, invites)
+            return None
+        roles = self._roles.get(guild_id, {})
+        snapshot = self._uses.setdefault(guild_id, {})
+        used = {}
+        for invite in invites:
+            if invite.code not in roles:
+                continue
+            uses = invite.uses or 0
+            if uses > snapshot.get(invite.code, 0):
+                used[invite.code] = uses - snapshot.get(invite.code, 0)
+            snapshot[invite.code] = uses
+        return used
+
+
+def attribute(rounds: list[tuple[int, int, dict[str, int]]]) -> list[typing.Optional[str]]:
+    """Attribute joins to the role invite uses of consecutive invite fetches, in join order.
+
+    Each round is ``(certain, uncertain, used)``: ``certain`` joins the fetch counts for sure,
+    followed by ``uncertain`` joins too close to it to tell, which the next fetch counts
+    otherwise, and the increments ``used`` it returned. The last round has no uncertain joins.
+
+    Use counts do not say which member used which invite, so the joins counted by one fetch
+    are only attributed when no role invite was used or a single one was used once per join.
+    Every split of the uncertain joins that leaves no fetch with more uses than joins is tried,
+    and a join gets a role invite only if all of them agree on it.
+    """
+    splits = math.prod(uncertain + 1 for _, uncertain, _ in rounds)
+    if splits > MAX_SPLITS:  # Treat the fetches as one, which needs no split at all
+        rounds = [(sum(certain + uncertain for certain, uncertain, _ in rounds), 0,
+                   sum((collections.Counter(used) for _, _, used in rounds), collections.Counter()))]
+    size = sum(certain + uncertain for certain, uncertain, _ in rounds)
+    agreed: typing.Optional[list] = None
+    for split in itertools.product(*(range(uncertain + 1) for _, uncertain, _ in rounds)):
+        codes = []
+        carried = 0  # Uncertain joins of the previous fetch that this one counts
+        for (certain, uncertain, used), counted in zip(rounds, split):
+            joins = carried + certain + counted
+            carried = uncertain - counted
+            uses = sum(used.values())
+            if uses > joins:
+                break  # More uses than joins, the split is wrong
+            if not uses:
+                codes += [None] * joins
+            elif len(used) == 1 and uses == joins:
+                codes += [next(iter(used))] * joins
+            else:
+                codes += [AMBIGUOUS] * joins
+        else:
+            agreed = codes if agreed is None else [a if a == b else AMBIGUOUS for a, b in zip(agreed, codes)]
+    if agreed is None:
+        return [None] * size  # No split explains the uses
+    return [None if code is AMBIGUOUS else code for code in agreed]
@@ -0,0 +1,92 @@
+"""Event-driven expiry and use limits of role invites."""
+import asyncio
+import contextlib
+import heapq
+import logging
+import time
+import typing
+
+
+class InviteTimers:
+    """Revokes role invites when they expire or their attributed uses reach ``max_uses``.
+
+    Expiry deadlines sit in a heap that a single task sleeps on until the earliest one is due.
+    Forgotten invites are not removed from the heap, their entries are skipped once they
+    surface. Use limits are counted here because Discord's own limit is bumped from 1 to 2
+    for single-use invites, which would otherwise vanish before the join is attributed.
+    """
+
+    MAX_SLEEP = 3600.0  # Re-check the wall clock at least this often
+    RETRY_DELAY = 60.0  # Wait before revoking again after a failed revoke
+
+    def __init__(self, revoke: typing.Callable[[int, str, str], typing.Awaitable[None]]):
+        self._revoke = revoke
+        self._heap: list[tuple[float, str, int]] = []
+        self._deadlines: dict[str, float] = {}
+        self._limits: dict[str, list[int]] = {}  # invite_id: [attributed uses, max_uses]
+        self._retries: dict[str, str] = {}  # invite_id: reason of the failed revoke
+        self._wakeup = asyncio.Event()
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines.keys() | self._limits.keys())
+
+    def track(self, guild_id: int, invite_id: str, uses: int, max_uses: int,
+              expires_at: typing.Optional[float]) -> None:
+        """Watch an invite that allows ``max_uses`` uses (0 for unlimited) until ``expires_at`` (None for never)."""
+        if max_uses:
+            self._limits[invite_id] = [uses, max_uses]
+        if expires_at:
+            self._deadlines[invite_id] = expires_at
+            heapq.heappush(self._heap, (expires_at, invite_id, guild_id))
+            if self._heap[0][1] == invite_id:
+                self._wakeup.set()  # The new deadline comes first, the sleeping task must wake earlier
+
+    def use(self, invite_id: str) -> bool:
+        """Count an attributed use and return whether the invite just ran out of uses."""
+        limit = self._limits.get(invite_id)
+        if limit is None:
+            return False
+        limit[0] += 1
+        return limit[0] >= limit[1]
+
+    def set_uses(self, invite_id: str, uses: int) -> None:
+        if invite_id in self._limits:
+            self._limits[invite_id][0] = uses
+
+    def retry(self, guild_id: int, invite_id: str, reason: str) -> None:
+        """Revoke the invite again after ``RETRY_DELAY`` seconds, once revoking it failed."""
+        self.forget(invite_id)
+        self._retries[invite_id] = reason
+        self.track(guild_id, invite_id, 0, 0, time.time() + self.RETRY_DELAY)
+
+    def forget(self, invite_id: str) -> None:
+        self._deadlines.pop(invite_id, None)
+        self._limits.pop(invite_id, None)
+        self._retries.pop(invite_id, None)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)  # Forgotten or rescheduled
+            delay = self._heap[0][0] - time.time() if self._heap else self.MAX_SLEEP
+            if delay > 0:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, self.MAX_SLEEP))
+                continue
+            _, invite_id, guild_id = heapq.heappop(self._heap)
+            reason = self._retries.get(invite_id, "expired")
+            self.forget(invite_id)
+            try:
+                await self._revoke(guild_id, invite_id, reason)
+            except Exception as e:
+                logging.error(f"Error revoking expired invite {invite_id}: {str(e)}")
+
+    def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,123 @@
+"""Write-behind buffering of invite use counts, upserts, deletes and attributed joins."""
+import asyncio
+import collections
+import contextlib
+import logging
+import sqlite3
+import typing
+
+from database import apply_invite_writes
+
+
+class InviteWriteBuffer:
+    """Collects invite writes in memory and commits them together in one transaction.
+
+    Changes are flushed ``interval`` seconds after the first one arrives, or right away once
+    ``max_pending`` invites have changes waiting. Within a flush, deletes are applied before
+    upserts and use increments, which matches the order of the events they came from as an
+    invite code is never reused after being deleted.
+    """
+
+    def __init__(self, interval: float = 1.0, max_pending: int = 500):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._deleted: set[str] = set()
+        self._records: dict[str, tuple[int, typing.Optional[int], int, int]] = {}
+        self._increments: collections.Counter[str] = collections.Counter()
+        self._attributions: list[tuple[int, int, str, int, float]] = []
+        self._timer: typing.Optional[asyncio.Task] = None
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._deleted) + len(self._records) + len(self._increments) + len(self._attributions)
+
+    def record(self, invite_id: str, guild_id: int, inviter: typing.Optional[int], uses: int, max_uses: int) -> None:
+        """Queue an upsert that keeps the role and never lowers the uses of an invite that is already stored.
+
+        Only role invites are incremented, and their stored uses count attributed joins, so
+        pending increments are kept: a late event must not undo the joins counted since.
+        """
+        self._records[invite_id] = (guild_id, inviter, uses, max_uses)
+        self._schedule()
+
+    def increment(self, invite_id: str) -> None:
+        self._increments[invite_id] += 1
+        self._schedule()
+
+    def attribute(self, guild_id: int, user_id: int, invite_id: str, role_id: int, joined_at: float) -> None:
+        """Log that a member joined through a role invite."""
+        self._attributions.append((guild_id, user_id, invite_id, role_id, joined_at))
+        self._schedule()
+
+    def delete(self, invite_id: str) -> None:
+        self._deleted.add(invite_id)
+        self._records.pop(invite_id, None)
+        self._increments.pop(invite_id, None)
+        self._schedule()
+
+    def overlay(self, rows: list[tuple[str, int, int, int]]) -> list[tuple[str, int, int, int]]:
+        """Apply pending changes to ``(invite_id, role_id, uses, max_uses)`` rows read from the database."""
+        result = []
+        for invite_id, role_id, uses, max_uses in rows:
+            if invite_id in self._deleted and invite_id not in self._records:
+                continue
+            if invite_id in self._records:
+                uses = max(uses, self._records[invite_id][2])
+            result.append((invite_id, role_id, uses + self._increments[invite_id], max_uses))
+        return result
+
+    def _schedule(self) -> None:
+        if len(self) >= self.max_pending:
+            self._full.set()
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), self.interval)
+        finally:
+            self._timer = None
+            self._full.clear()
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Commit every pending change, keeping them for the next flush if the commit fails."""
+        async with self._lock:
+            if not len(self):
+                return
+            deleted, records, increments = self._deleted, self._records, self._increments
+            attributions = self._attributions
+            self._deleted, self._records, self._increments = set(), {}, collections.Counter()
+            self._attributions = []
+            try:
+                await apply_invite_writes(
+                    list(deleted),
+                    [(invite_id, *record) for invite_id, record in records.items()],
+                    [(count, invite_id) for invite_id, count in increments.items()],
+                    attributions
+                )
+            except sqlite3.Error as e:
+                logging.error(f"Failed to write {len(deleted) + len(records) + len(increments) + len(attributions)} "
+                              f"invite changes, retrying with the next flush: {e}")
+                self._restore(deleted, records, increments)
+                self._attributions[:0] = attributions
+                self._schedule()
+
+    def _restore(self, deleted: set[str], records: dict, increments: collections.Counter) -> None:
+        """Put changes of a failed flush back behind the ones that arrived meanwhile."""
+        for invite_id, count in increments.items():
+            if invite_id not in self._deleted:  # Not superseded meanwhile
+                self._increments[invite_id] += count
+        for invite_id, record in records.items():
+            if invite_id not in self._deleted:
+                self._records.setdefault(invite_id, record)
+        self._deleted |= deleted
+
+    async def close(self) -> None:
+        """Stop the flush timer and write out everything still pending."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
@@ -0,0 +1,84 @@
+"""Per-guild coalescing of member joins."""
+import asyncio
+import contextlib
+import logging
+import time
+import typing
+
+import discord
+
+from metrics import JOIN_BATCH_SIZE
+
+
+class JoinQueue:
+    """Batches joins per guild so a burst is attributed from a single invite fetch.
+
+    The joins of a guild that arrive while its previous batch is flushed are handed to
+    ``flush`` together as the next batch, and batches of one guild never overlap. The first
+    join of an idle guild is flushed after ``window`` seconds, so a lone join is attributed
+    right away while a burst coalesces into one batch per flush.
+    """
+
+    def __init__(self, flush: typing.Callable[[discord.Guild, list[discord.Member]], typing.Awaitable[None]],
+                 window: float = 0.0):
+        self._flush = flush
+        self.window = window
+        self._batches: dict[int, list[discord.Member]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._arrivals: dict[int, asyncio.Event] = {}
+        self.joins = 0
+        self.batches = 0
+        self.busy_time = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Joins processed per second spent flushing batches."""
+        return self.joins / self.busy_time if self.busy_time else 0.0
+
+    def put(self, member: discord.Member) -> None:
+        self._batches.setdefault(member.guild.id, []).append(member)
+        if arrival := self._arrivals.get(member.guild.id):
+            arrival.set()
+        if member.guild.id not in self._tasks:
+            self._tasks[member.guild.id] = asyncio.create_task(self._run(member.guild))
+
+    def take(self, guild_id: int) -> list[discord.Member]:
+        """Remove and return the joins of a guild waiting for the next batch."""
+        return self._batches.pop(guild_id, [])
+
+    def put_back(self, guild_id: int, members: list[discord.Member]) -> None:
+        """Queue taken joins again ahead of the ones waiting, they go into the next batch of the guild."""
+        if members:
+            self._batches[guild_id] = members + self._batches.get(guild_id, [])
+
+    async def wait(self, guild_id: int, timeout: float) -> None:
+        """Wait until a join of the guild is queued, or ``timeout`` seconds pass."""
+        arrival = self._arrivals.setdefault(guild_id, asyncio.Event())
+        try:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(arrival.wait(), timeout)
+        finally:
+            self._arrivals.pop(guild_id, None)
+
+    async def _run(self, guild: discord.Guild) -> None:
+        try:
+            await asyncio.sleep(self.window)  # Collect the joins arriving right after the first one
+            while self._batches.get(guild.id):
+                batch = self._batches.pop(guild.id)
+                JOIN_BATCH_SIZE.observe(len(batch))
+                started = time.perf_counter()
+                try:
+                    await self._flush(guild, batch)
+                except Exception as e:
+                    logging.error(f"Error processing {len(batch)} joins in {guild.name}: {str(e)}")
+                self.joins += len(batch)
+                self.batches += 1
+                self.busy_time += time.perf_counter() - started
+        finally:
+            self._tasks.pop(guild.id, None)
+
+    def close(self) -> None:
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self._batches.clear()
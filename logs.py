@@ -0,0 +1,70 @@
+"""Logging through a bounded queue that is drained by a background thread.
+
+The event loop only appends records to the queue; formatting, file writes and log rotation
+happen on the listener thread. When the queue is full, records are dropped and counted
+instead of blocking the loop.
+"""
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from metrics import LOG_DROPPED
+
+# Attributes hot paths pass through ``extra`` and the JSON format emits as fields
+FIELDS = ("guild_id", "member_id", "invite", "latency")
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener unformatted and drops them while the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # Formatting is left to the listener thread
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc(record.levelname)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the structured fields of the record when set."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            if (value := getattr(record, field, None)) is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(filename: str, structured: bool = False, capacity: int = 10_000,
+                  level: int = logging.INFO) -> QueueListener:
+    """Route the root logger through a queue of ``capacity`` records and return the started listener."""
+    if structured:
+        formatter: logging.Formatter = JsonFormatter(datefmt='%Y-%m-%dT%H:%M:%S')
+    else:
+        formatter = logging.Formatter('%(asctime)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    handlers: list[logging.Handler] = [
+        RotatingFileHandler(filename, maxBytes=5242880, backupCount=5, encoding='utf-8', mode='a'),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records: queue.Queue = queue.Queue(maxsize=capacity)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DroppingQueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
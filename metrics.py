@@ -0,0 +1,217 @@
+"""Low-overhead in-process metrics, exposed in the Prometheus text format.
+
+Every metric lives in plain dicts and is only touched from the event loop, so recording
+is a dict lookup and an addition. Nothing is formatted until the endpoint is scraped.
+"""
+import bisect
+import collections
+import contextlib
+import time
+import typing
+
+from aiohttp import web
+from discord.http import HTTPClient, Route
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: list["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        _registry.append(self)
+
+    def samples(self) -> typing.Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: collections.defaultdict[tuple, float] = collections.defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] += amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, *labels) -> None:
+        self._values[labels] = value
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # Per label set: [count per bucket with a final +Inf slot, sum, count]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def quantile(self, q: float, *labels) -> typing.Optional[float]:
+        """Upper bound of the bucket holding the ``q`` quantile, None without observations."""
+        series = self._series.get(labels)
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for bound, count in zip((*self.buckets, float("inf")), series[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> typing.Iterator[str]:
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+
+
+class GuildRate:
+    """REST calls per guild in the current and the last full minute.
+
+    Kept out of the Prometheus output on purpose, a label per guild would explode its series count.
+    """
+
+    def __init__(self):
+        self._minute = 0
+        self._current: collections.Counter = collections.Counter()
+        self._last: collections.Counter = collections.Counter()
+
+    def _roll(self) -> None:
+        minute = int(time.monotonic() // 60)
+        if minute != self._minute:
+            self._last = self._current if minute == self._minute + 1 else collections.Counter()
+            self._current = collections.Counter()
+            self._minute = minute
+
+    def hit(self, guild_id: int) -> None:
+        self._roll()
+        self._current[guild_id] += 1
+
+    def last_minute(self, guild_id: int) -> int:
+        self._roll()
+        return self._last[guild_id]
+
+
+JOIN_TO_ROLE = Histogram("roleinvite_join_to_role_seconds", "Time from a member joining to their roles being granted.")
+JOIN_BATCH_SIZE = Histogram("roleinvite_join_batch_size", "Joins attributed together from one invite fetch.",
+                            buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+JOINS = Counter("roleinvite_joins_total", "Joins processed, by whether a role invite was attributed.", ("attributed",))
+ROLE_GRANTS = Counter("roleinvite_role_grants_total", "Role grant attempts by outcome.", ("result",))
+DB_QUERY = Histogram("roleinvite_db_query_seconds", "Database helper latency including queueing.", ("query",))
+REST_REQUESTS = Histogram("roleinvite_rest_request_seconds", "Discord REST request latency by route.", ("route",))
+LOOP_ITERATION = Histogram("roleinvite_loop_iteration_seconds", "Duration of one background loop iteration.",
+                           ("loop",))
+RECONCILE_PASS = Histogram("roleinvite_reconcile_pass_seconds", "Duration of a full invite reconciliation pass.",
+                           buckets=(1, 2.5, 5, 10, 15, 20, 30, 60, 120, 300))
+RECONCILE_QUEUE = Gauge("roleinvite_reconcile_queue_depth", "Guilds waiting in the current reconciliation pass.",
+                        ("shard",))
+CLEAR_JOB = Histogram("clear_job_seconds", "Duration of a clear job.",
+                      buckets=(1, 5, 10, 30, 60, 300, 900, 1800, 3600))
+CLEAR_DELETED = Counter("clear_messages_deleted_total", "Messages deleted by the clear commands, by lane.", ("lane",))
+LOG_DROPPED = Counter("roleinvite_log_records_dropped_total", "Log records dropped because the log queue was full.",
+                      ("level",))
+GUILD_REST = GuildRate()
+
+
+def instrument_http(http: HTTPClient) -> None:
+    """Count and time every REST request the client makes, per route and per guild."""
+    request = http.request
+
+    async def timed_request(route: Route, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            REST_REQUESTS.observe(time.perf_counter() - started, route.key)
+            if route.guild_id is not None:
+                GUILD_REST.hit(int(route.guild_id))
+
+    http.request = timed_request
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+async def start_http_server(port: int, host: str = "127.0.0.1") -> web.AppRunner:
+    """Serve ``/metrics`` on a local port and return the runner to clean up on shutdown."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
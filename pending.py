@@ -0,0 +1,59 @@
+"""Bounded, persistent tracking of members going through membership screening."""
+import collections
+import time
+import typing
+
+import discord
+
+from database import load_pending_members, save_pending_member, delete_pending_member, purge_pending_members
+
+
+class PendingMembers:
+    """Invite attribution of members that have not finished membership screening yet.
+
+    Entries are keyed by ``(guild_id, user_id)``, kept in join order and mirrored to the
+    database so they survive restarts. Members that do not finish screening within ``ttl``
+    seconds are evicted, as are the oldest entries once ``max_size`` is exceeded.
+    """
+
+    def __init__(self, ttl: float = 7 * 86400, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._members: collections.OrderedDict[tuple[int, int], tuple[typing.Optional[str], float]] = \
+            collections.OrderedDict()
+
+    def __contains__(self, member: discord.Member) -> bool:
+        return (member.guild.id, member.id) in self._members
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __iter__(self) -> typing.Iterator[tuple[int, int]]:
+        return iter(list(self._members))
+
+    async def load(self, owns_guild: typing.Callable[[int], bool] = lambda guild_id: True) -> None:
+        """Load the tracked members of every guild ``owns_guild`` accepts."""
+        for guild_id, user_id, invite_id, joined_at in await load_pending_members(time.time() - self.ttl):
+            if owns_guild(guild_id):
+                self._members[(guild_id, user_id)] = (invite_id, joined_at)
+
+    async def add(self, member: discord.Member, invite_code: typing.Optional[str]) -> None:
+        joined_at = time.time()
+        self._members[(member.guild.id, member.id)] = (invite_code, joined_at)
+        self._members.move_to_end((member.guild.id, member.id))
+        await save_pending_member(member.guild.id, member.id, invite_code, joined_at)
+        while len(self._members) > self.max_size:
+            (guild_id, user_id), _ = self._members.popitem(last=False)
+            await delete_pending_member(guild_id, user_id)
+
+    async def pop(self, guild_id: int, user_id: int) -> typing.Optional[str]:
+        """Stop tracking a member and return the invite code they joined through."""
+        invite_code, _ = self._members.pop((guild_id, user_id))
+        await delete_pending_member(guild_id, user_id)
+        return invite_code
+
+    async def evict_expired(self) -> None:
+        cutoff = time.time() - self.ttl
+        while self._members and next(iter(self._members.values()))[1] < cutoff:
+            self._members.popitem(last=False)
+        await purge_pending_members(cutoff)
@@ -1,126 +1,40 @@
+import hashlib
+import json
 import os
+import sys
+import time
 import discord
 from discord import app_commands, Embed, Color, Interaction
 from discord.ext import commands, tasks
 from discord.ext.commands import has_permissions
+from aiohttp import web
 from clear import ClearCommands
-import sqlite3
+from invite_cache import InviteCache, attribute
+from join_queue import JoinQueue
+from scheduler import ReconcileScheduler
+from sharding import launch, shard_of, shard_ids_for
+from role_grants import RoleGrants
+from pending import PendingMembers
+from utils import timer
+from logs import setup_logging
+import metrics
+from invite_writes import InviteWriteBuffer
+from invite_timers import InviteTimers
+from guild_config import GuildConfigCache
+from database import (init_db, close_db, load_invite_page, load_role_invites, load_invite_limits, save_invite,
+                      reconcile_invites, update_invite_uses, get_setting, set_setting, load_attribution_stats,
+                      count_attributed_joins, HOUR, DAY)
 import logging
-from logging.handlers import RotatingFileHandler
 import asyncio
-import re
 import typing
 
 import clear
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s | %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        RotatingFileHandler('roleinvite.log', maxBytes=5242880, backupCount=5, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
-)
-
-
-DB_PATH = "invites.db"
-
-
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS invites (
-        _id INTEGER PRIMARY KEY,
-        invite_id TEXT UNIQUE,
-        guild_id TEXT,
-        role_id INTEGER,
-        inviter INTEGER,
-        uses INTEGER DEFAULT 0,
-        max_uses INTEGER,
-        duration INTEGER,
-        channel_id INTEGER
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS default_roles (
-        guild_id TEXT PRIMARY KEY,
-        role_id INTEGER
-    )''')
-    conn.commit()
-    conn.close()
-
-
-def timer(time: str) -> int:
-    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
-    match = re.fullmatch(r'([0-9]*\.?[0-9]+)([smhd])', time)
-    if match is None:
-        raise ValueError("Invalid time input")
-    return int(float(match[1]) * units[match[2]])
-
-
-def load_invites(guild_id: str) -> dict[str, dict[str, typing.Any]]:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM invites WHERE guild_id = ?", (guild_id,))
-    rows = c.fetchall()
-    invites = {}
-    for row in rows:
-        invites[row[1]] = {
-            "_id": row[0],
-            "guild_id": row[2],
-            "role_id": row[3],
-            "inviter": row[4],
-            "uses": row[5],
-            "max_uses": row[6],
-            "duration": row[7],
-            "channel_id": row[8],
-        }
-    conn.close()
-    return invites
-
-
-def save_invite(invite_id: str, guild_id: str, role_id: int, inviter: int, uses: int, max_uses: int,
-                duration: int, channel_id: int) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''INSERT OR REPLACE INTO invites (invite_id, guild_id, role_id, inviter, uses, max_uses, 
-                duration, channel_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-              (invite_id, guild_id, role_id, inviter, uses, max_uses, duration, channel_id))
-    conn.commit()
-    conn.close()
-
-
-def delete_invite(invite_id: str) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM invites WHERE invite_id = ?", (invite_id,))
-    conn.commit()
-    conn.close()
-
-
-def update_invite_uses(invite_id: str, uses: int) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE invites SET uses = ? WHERE invite_id = ?", (uses, invite_id))
-    conn.commit()
-    conn.close()
-
-
-def get_default_role(guild_id: int) -> int:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT role_id FROM default_roles WHERE guild_id = ?", (str(guild_id),))
-    result = c.fetchone()
-    conn.close()
-    return int(result[0]) if result else 0
-
-
-def set_default_role(guild_id: str, role_id: int) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO default_roles (guild_id, role_id) VALUES (?, ?)", (guild_id, role_id))
-    conn.commit()
-    conn.close()
+# Sharding: SHARD_COUNT shards (Discord's recommendation if unset) split across SHARD_PROCESSES
+# worker processes. The launcher sets SHARD_PROCESS to tell each worker its index.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0) or None
+SHARD_PROCESSES = int(os.getenv("SHARD_PROCESSES") or 1)
+SHARD_PROCESS = os.getenv("SHARD_PROCESS")
 
 intents = discord.Intents.default()
 intents.invites = True
@@ -128,14 +42,117 @@ intents.guilds = True
 intents.members = True
 intents.messages = True
 
-Role_Invite_Bot = commands.Bot(command_prefix="!", intents=intents)
-init_db()
+
+class RoleInviteBot(commands.AutoShardedBot):
+    async def setup_hook(self) -> None:
+        """Runs once before connecting, unlike on_ready which fires again after every reconnect."""
+        await setup(self)
+        if not SHARD_PROCESS or SHARD_PROCESS == "0":  # Commands are global, one worker syncing them is enough
+            await self.sync_commands()
+
+    async def sync_commands(self) -> None:
+        """Sync the global command tree, unless it is unchanged since the last sync."""
+        definitions = [command.to_dict(self.tree) for command in self.tree.get_commands()]
+        digest = hashlib.sha256(json.dumps([self.application_id, definitions], sort_keys=True).encode()).hexdigest()
+        if await get_setting("command_tree_hash") == digest:
+            logging.info("Command tree unchanged since the last sync, skipping it.")
+            return
+        await self.tree.sync()
+        await set_setting("command_tree_hash", digest)
+        logging.info(f"Synced {len(definitions)} commands.")
+
+    async def on_ready(self) -> None:
+        print(f"Bot is ready! Logged in as {self.user}")
+
+
+class InviteListView(discord.ui.View):
+    """Pages through a guild's invites, fetching only the visible page with a keyset query."""
+
+    PAGE_SIZE = 25  # Fields per embed
+
+    def __init__(self, user: discord.abc.User, guild: discord.Guild, writes: InviteWriteBuffer):
+        super().__init__(timeout=300)
+        self.user = user
+        self.guild = guild
+        self.writes = writes
+        self.page = -1
+        self.first_id: typing.Optional[str] = None
+        self.last_id: typing.Optional[str] = None
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.user.id
+
+    async def next_page(self) -> typing.Optional[discord.Embed]:
+        rows = await load_invite_page(self.guild.id, self.PAGE_SIZE + 1, after=self.last_id)
+        if not rows:
+            return None
+        self.page += 1
+        self.next.disabled = len(rows) <= self.PAGE_SIZE
+        return self._render(rows[:self.PAGE_SIZE])
+
+    async def previous_page(self) -> typing.Optional[discord.Embed]:
+        rows = await load_invite_page(self.guild.id, self.PAGE_SIZE, before=self.first_id)
+        if len(rows) < self.PAGE_SIZE:  # Invites were deleted meanwhile, start over
+            self.page, self.last_id = -1, None
+            return await self.next_page()
+        self.page -= 1
+        self.next.disabled = False
+        return self._render(rows[::-1])
+
+    def _render(self, rows: list[tuple[str, int, int, int]]) -> discord.Embed:
+        self.first_id, self.last_id = rows[0][0], rows[-1][0]
+        self.previous.disabled = self.page == 0
+        embed = discord.Embed(title="Role Invites", color=discord.Color.blue())
+        embed.set_footer(text=f"Page {self.page + 1}")
+        rows = self.writes.overlay(rows)  # Show changes that are not flushed yet
+        for index, (invite_id, role_id, uses, max_uses) in enumerate(rows, self.page * self.PAGE_SIZE + 1):
+            role = self.guild.get_role(role_id) if role_id else None
+            embed.add_field(
+                name=f"Invite #{index}",
+                value=f"[{invite_id}](https://discord.gg/{invite_id})\n"
+                      f"Role: {f'<@&{role.id}>' if role else 'Role not found'}\n"
+                      f"Uses: {uses} / {max_uses if max_uses else '∞'}",
+                inline=True
+            )
+        return embed
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, disabled=True)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, await self.previous_page())
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._show(interaction, await self.next_page())
+
+    async def _show(self, interaction: discord.Interaction, embed: typing.Optional[discord.Embed]):
+        if embed is None:
+            await interaction.response.edit_message(content="No role invites available.", embed=None, view=None)
+        else:
+            await interaction.response.edit_message(embed=embed, view=self)
 
 
 class RoleInvite(commands.Cog, name="roleinvite"):
+    WARMUP_CONCURRENCY = 8  # Guilds whose invites are fetched at once while warming the caches
+    # Expiry and use limits are enforced by the invite timers and gateway invite events mark their guild
+    # dirty, so the full reconciliation pass only catches what was missed and can run rarely
+    RECONCILE_INTERVAL = 120
+    SETTLE_DELAY = 0.5  # Longest gateway delay of a join event, after it every join an invite fetch counts is known
+    ROUND_TRIP = 0.1  # Longest time from Discord counting the invite uses to the fetch returning them
+    CLOCK_SKEW = 0.02  # Largest difference between our clock and Discord's join times
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.pending: set = set()
+        self.guild_configs = GuildConfigCache()
+        self._warmed = asyncio.Event()
+        self.pending = PendingMembers()
+        self.invite_cache = InviteCache()
+        self.join_queue = JoinQueue(self._process_joins)
+        self.role_grants = RoleGrants()
+        self.reconcile_schedulers: dict[int, ReconcileScheduler] = {}
+        self.invite_writes = InviteWriteBuffer()
+        self.invite_timers = InviteTimers(self._revoke_invite)
+        self._startup_task: typing.Optional[asyncio.Task] = None
+        self._metrics_server: typing.Optional[web.AppRunner] = None
 
     invite_group = app_commands.Group(name="rinv", description="Commands for managing role invites", guild_only=True)
 
@@ -143,7 +160,9 @@ class RoleInvite(commands.Cog, name="roleinvite"):
     @commands.has_permissions(administrator=True)
     async def update_invite(self, interaction: discord.Interaction, invite_id: str, uses: int) -> None:
         try:
-            update_invite_uses(invite_id, uses)
+            await self.invite_writes.flush()  # Pending increments must not land on top of the new value
+            await update_invite_uses(invite_id, uses)
+            self.invite_timers.set_uses(invite_id, uses)
             await interaction.response.send_message(f"Invite {invite_id} uses updated to {uses}.", ephemeral=True)
         except Exception as e:
             await interaction.response.send_message(f"Failed to update invite: {e}", ephemeral=True)
@@ -154,7 +173,7 @@ class RoleInvite(commands.Cog, name="roleinvite"):
         try:
             invite = await self.bot.fetch_invite(invite_id)
             await invite.delete()
-            delete_invite(invite_id)
+            self._forget_invite(interaction.guild.id, invite.code)
             await interaction.response.send_message(f"Revoked invite {invite.url}", ephemeral=True)
         except Exception as e:
             await interaction.response.send_message(f"Failed to update invite: {e}", ephemeral=True)
@@ -192,8 +211,11 @@ class RoleInvite(commands.Cog, name="roleinvite"):
                 max_uses=max_uses if not max_uses == 1 else 2,
                 reason=f"Role Invite for {role.name} by {interaction.user.name}"
             )
-            guild_id = str(interaction.guild.id)
-            save_invite(invite.id, guild_id, role.id, interaction.user.id, 0, max_uses, duration_seconds, channel.id)
+            expires_at = invite.expires_at.timestamp() if invite.expires_at else None
+            await save_invite(invite.id, interaction.guild.id, role.id, interaction.user.id, 0, max_uses or 0,
+                              duration_seconds, channel.id, expires_at)
+            self.invite_cache.track(interaction.guild.id, invite.code, role.id)
+            self.invite_timers.track(interaction.guild.id, invite.code, 0, max_uses or 0, expires_at)
             await interaction.followup.send(
                 f"Role Invite created! Users who use the invite `{invite.url}` will receive the role **{role.name}**.",
                 ephemeral=True
@@ -204,36 +226,102 @@ class RoleInvite(commands.Cog, name="roleinvite"):
     @invite_group.command(name="list", description="List all Role Invites")
     @commands.has_permissions(administrator=True)
     async def list_invites(self, interaction: discord.Interaction) -> None:
-        guild_id = str(interaction.guild.id)
-        invites_data = load_invites(guild_id)
         await interaction.response.defer(ephemeral=True)
-        if not invites_data:
-            await interaction.response.send_message("No role invites available.")
+        view = InviteListView(interaction.user, interaction.guild, self.invite_writes)
+        embed = await view.next_page()
+        if embed is None:
+            await interaction.followup.send("No role invites available.", ephemeral=True)
             return
-        embeds = []
-        current_embed = discord.Embed(title="Role Invites", color=discord.Color.blue())
-        for index, (invite_id, data) in enumerate(invites_data.items(), 1):
-            invite_url = f"https://discord.gg/{invite_id}"
-            role = interaction.guild.get_role(data['role_id'])
-            current_embed.add_field(
-                name=f"Invite #{index}",
-                value=f"[{invite_id}]({invite_url})\n"
-                      f"Role: {f'<@&{role.id}>' if role else 'Role not found'}\n"
-                      f"Uses: {data['uses']} / {data['max_uses'] if data['max_uses'] else "∞"}",
-                inline=True
-            )
-            if index % 5 == 0:
-                embeds.append(current_embed)
-                current_embed = discord.Embed(title="Role Invites", color=discord.Color.blue())
-        embeds.append(current_embed)
-        for embed in embeds:
+        await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+
+    @invite_group.command(name="setdefault", description="Set the default roles for new members in the guild")
+    @app_commands.describe(role="Default role", role_2="Additional default role", role_3="Additional default role",
+                           role_4="Additional default role", role_5="Additional default role")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def set_default_role(
+            self,
+            interaction: discord.Interaction,
+            role: discord.Role,
+            role_2: typing.Optional[discord.Role] = None,
+            role_3: typing.Optional[discord.Role] = None,
+            role_4: typing.Optional[discord.Role] = None,
+            role_5: typing.Optional[discord.Role] = None
+    ) -> None:
+        roles = list(dict.fromkeys(r for r in (role, role_2, role_3, role_4, role_5) if r))
+        await self.guild_configs.set_default_roles(interaction.guild.id, [r.id for r in roles])
+        await interaction.response.send_message(
+            f"Default roles set to {', '.join(r.name for r in roles)}.", ephemeral=True
+        )
+
+    @invite_group.command(name="cleardefault", description="Stop giving default roles to new members in the guild")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def clear_default_roles(self, interaction: discord.Interaction) -> None:
+        await self.guild_configs.set_default_roles(interaction.guild.id, [])
+        await interaction.response.send_message("Default roles removed.", ephemeral=True)
+
+    @invite_group.command(name="stats", description="Show join statistics of invites and inviters, or of the bot")
+    @app_commands.describe(invite="Only count joins through this invite code",
+                           inviter="Only count joins through invites of this member",
+                           days="Number of days to count joins for")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def stats(
+            self,
+            interaction: discord.Interaction,
+            invite: typing.Optional[str] = None,
+            inviter: typing.Optional[discord.User] = None,
+            days: app_commands.Range[int, 1, 90] = 7
+    ) -> None:
+        await interaction.response.defer(ephemeral=True)
+        await self.invite_writes.flush()  # Count the joins attributed since the last flush too
+        guild_id = interaction.guild.id
+        since = time.time() - days * DAY
+        if invite or inviter:
+            inviter_id = inviter.id if inviter else None
+            last_day = await count_attributed_joins(guild_id, HOUR, time.time() - DAY, invite, inviter_id)
+            total = await count_attributed_joins(guild_id, DAY, since, invite, inviter_id)
+            period = await load_attribution_stats(guild_id, DAY, since, "invite_id", invite, inviter_id, limit=10)
+            embed = discord.Embed(title="Join Statistics", color=Color.blue())
+            embed.description = " and ".join(filter(None, [f"Invite `{invite}`" if invite else None,
+                                                           f"Invites of {inviter.mention}" if inviter else None]))
+            embed.add_field(name="Last 24 hours", value=f"{last_day} joins", inline=True)
+            embed.add_field(name=f"Last {days} days", value=f"{total} joins", inline=True)
+            if inviter and period:
+                embed.add_field(name="Top invites", inline=False,
+                                value="\n".join(f"`{invite_id}`: {joins}" for invite_id, joins in period))
             await interaction.followup.send(embed=embed, ephemeral=True)
+            return
 
-    @invite_group.command(name="setdefault", description="Set a default role for new members in the guild")
-    @commands.has_permissions(administrator=True)
-    async def set_default_role(self, interaction: discord.Interaction, role: discord.Role) -> None:
-        set_default_role(str(interaction.guild.id), role.id)
-        await interaction.response.send_message(f"Default role set to {role.name}.", ephemeral=True)
+        def seconds(value: typing.Optional[float]) -> str:
+            return f"≤ {value:g}s" if value is not None else "n/a"
+
+        joins = metrics.JOINS.value("true") + metrics.JOINS.value("false")
+        scheduler = self._scheduler_for(interaction.guild.id)
+        embed = discord.Embed(title="Bot Statistics", color=Color.blue())
+        embed.add_field(name="Join to role",
+                        value=f"p50 {seconds(metrics.JOIN_TO_ROLE.quantile(0.5))}\n"
+                              f"p99 {seconds(metrics.JOIN_TO_ROLE.quantile(0.99))}", inline=True)
+        embed.add_field(name="Joins",
+                        value=f"{joins:.0f} processed, {metrics.JOINS.value('true'):.0f} attributed\n"
+                              f"{self.join_queue.throughput:.1f} joins/s", inline=True)
+        embed.add_field(name="Role grants",
+                        value=f"{metrics.ROLE_GRANTS.value('success'):.0f} granted\n"
+                              f"{metrics.ROLE_GRANTS.value('retry'):.0f} retried, "
+                              f"{metrics.ROLE_GRANTS.value('failed'):.0f} failed", inline=True)
+        embed.add_field(name="REST calls",
+                        value=f"{metrics.GUILD_REST.last_minute(interaction.guild.id)} for this guild last minute",
+                        inline=True)
+        embed.add_field(name="Invite reconciliation",
+                        value=f"Last pass {scheduler.last_pass_duration:.1f}s\n"
+                              f"{scheduler.queue_depth} guilds queued on shard {scheduler.shard_id}", inline=True)
+        embed.add_field(name="Pending members", value=f"{len(self.pending)}", inline=True)
+        top_invites = await load_attribution_stats(guild_id, DAY, since, "invite_id")
+        top_inviters = await load_attribution_stats(guild_id, DAY, since, "inviter")
+        embed.add_field(name=f"Top invites ({days} days)", inline=True,
+                        value="\n".join(f"`{invite_id}`: {joins}" for invite_id, joins in top_invites) or "No joins")
+        embed.add_field(name=f"Top inviters ({days} days)", inline=True,
+                        value="\n".join(f"<@{user_id}>: {joins}" if user_id else f"Unknown: {joins}"
+                                        for user_id, joins in top_inviters) or "No joins")
+        await interaction.followup.send(embed=embed, ephemeral=True)
 
     @app_commands.command(name="info", description="Shows bot info")
     @commands.has_permissions(administrator=True)
@@ -251,141 +339,331 @@ class RoleInvite(commands.Cog, name="roleinvite"):
     @commands.Cog.listener()
     async def on_invite_create(self, invite: discord.Invite):
         """Listen for new invites being created and save them in the database."""
-        guild_id = str(invite.guild.id)
-        save_invite(invite.id, guild_id, 0, invite.inviter.id, invite.uses, invite.max_uses or 0, 0, 0)
+        self.invite_writes.record(invite.id, invite.guild.id, invite.inviter.id if invite.inviter else None,
+                                  invite.uses or 0, invite.max_uses or 0)
+        self.invite_cache.set_uses(invite.guild.id, invite.code, invite.uses or 0)
+        self._scheduler_for(invite.guild.id).mark_dirty(invite.guild.id)
 
     @commands.Cog.listener()
     async def on_invite_delete(self, invite: discord.Invite):
         """Listen for invites being deleted and remove them from the database."""
-        delete_invite(invite.id)
+        self._forget_invite(invite.guild.id, invite.code)
+        self._scheduler_for(invite.guild.id).mark_dirty(invite.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.invite_cache.drop_guild(guild.id)
 
     @commands.Cog.listener(name="on_member_join")
     async def on_member_join(self, member: discord.Member):
-        """Event handler for member joins, assigns role based on invite used and updates invite data."""
-        try:
-            guild_invites_list = await member.guild.invites()
-        except discord.Forbidden:
-            return  # Permissions to view invites were denied
+        """Event handler for member joins, queues the member for batched invite attribution."""
+        self.join_queue.put(member)
 
-        if member.pending:
-            return self.pending.add(member)
-        if default_role := member.guild.get_role(get_default_role(member.guild.id)):
-            await member.add_roles(default_role)
-        await self._give_role(member, guild_invites_list)
-
-    @tasks.loop(seconds=10)
-    async def clean_up_invites(self):
-        """Ensure invites from the server are present in the database and remove any that are not."""
-        # Get current invites from the server
-        current_invites = {}
-        for guild in self.bot.guilds:
-            try:
-                invites = await guild.invites()
-                for invite in invites:
-                    current_invites[invite.id] = (
-                    invite.code, invite.uses, str(guild.id), invite.inviter.id, invite.max_uses, invite.channel.id)
-            except discord.Forbidden:
+    async def _process_joins(self, guild: discord.Guild, members: list[discord.Member]):
+        """Attribute a batch of joins from one invite fetch, then assign their roles in one pass."""
+        await self._warmed.wait()  # Attribution needs the invite snapshot taken while warming up
+        try:
+            invite_codes = await self._find_used_invites(guild, members)
+        except discord.HTTPException as e:
+            # Invites could not be fetched, e.g. missing permissions or a server error, the members still get
+            # the default roles. ``members`` includes the joins taken from the queue before the error.
+            logging.warning("Could not fetch the invites of %s, granting default roles only to %d joins: %s",
+                            guild.name, len(members), e, extra={"guild_id": guild.id})
+            metrics.JOINS.inc("false", amount=len(members))
+            self.invite_cache.invalidate(guild.id)  # The next fetch also counts the uses of these members
+            invite_codes = [None] * len(members)
+
+        default_roles = self._default_roles(guild)
+        for member, invite_code in zip(members, invite_codes):
+            if member.pending:
+                await self.pending.add(member, invite_code)
                 continue
+            await self._give_role(member, invite_code, default_roles)
 
-        """Get all invite IDs from the database."""
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT invite_id FROM invites")
-        db_invite_ids = {row[0] for row in cursor.fetchall()}
-
-        # Find invites that are in the server but not in the database
-        invites_to_add = []
-        for invite_id, (invite_code, invite_uses, guild_id, inviter, max_uses, channel_id) in current_invites.items():
-            if invite_id not in db_invite_ids:
-                # Append only the necessary fields for saving, and use None for missing fields
-                invites_to_add.append((invite_id, guild_id, None, inviter, invite_uses, max_uses, None,
-                                       channel_id))  # None for role_id and duration
-
-        # Insert missing invites into the database
-        for invite_data in invites_to_add:
-            save_invite(*invite_data)
+    async def start_up(self):
+        await self.bot.wait_until_ready()
+        started = time.monotonic()
+        try:
+            await self.warm_caches()
+            logging.info(f"Warmed the invite and default role caches in {time.monotonic() - started:.1f}s.")
+        except Exception as e:
+            # Without a complete snapshot every use would look new, so joins only get the default roles
+            self.invite_cache.clear()
+            logging.error(f"Failed to warm the caches, existing role invites are not attributed until a restart: {e}")
+        finally:
+            self._warmed.set()
+        await self.restore_pending_members()
+
+    async def warm_caches(self):
+        """Load role invites and default roles, then snapshot live invite uses of several guilds at once."""
+        role_invites, limits, _ = await asyncio.gather(load_role_invites(), load_invite_limits(),
+                                                       self.guild_configs.load(self.owns_guild))
+        for guild_id, invite_id, role_id, uses in role_invites:
+            if self.owns_guild(guild_id):
+                self.invite_cache.track(guild_id, invite_id, role_id, uses)
+        for guild_id, invite_id, uses, max_uses, expires_at in limits:
+            if self.owns_guild(guild_id):
+                self.invite_timers.track(guild_id, invite_id, uses, max_uses, expires_at)
+
+        semaphore = asyncio.Semaphore(self.WARMUP_CONCURRENCY)
+
+        async def snapshot(guild: discord.Guild):
+            async with semaphore:
+                try:
+                    self.invite_cache.seed(guild.id, await guild.invites())
+                except discord.HTTPException as e:
+                    logging.warning(f"Could not snapshot invites of {guild.name}: {e}")
+
+        await asyncio.gather(*(snapshot(guild) for guild in self.bot.guilds
+                               if self.invite_cache.has_role_invites(guild.id)))
+
+    async def restore_pending_members(self):
+        """Load members still in screening and serve those who finished it while the bot was offline."""
+        await self.pending.load(self.owns_guild)
+        for guild_id, user_id in self.pending:
+            guild = self.bot.get_guild(guild_id)
+            member = guild.get_member(user_id) if guild else None
+            # on_member_update may have served the member while an earlier one was being served
+            if member and not member.pending and member in self.pending:
+                invite_code = await self.pending.pop(guild_id, user_id)
+                await self._give_role(member, invite_code, self._default_roles(guild))
+
+    @tasks.loop(hours=1)
+    async def evict_pending_members(self):
+        """Forget members that never finished membership screening."""
+        with metrics.LOOP_ITERATION.time("evict_pending_members"):
+            await self.pending.evict_expired()
+
+    async def _find_used_invites(self, guild: discord.Guild,
+                                 members: list[discord.Member]) -> list[typing.Optional[str]]:
+        """Return the role invite code each member joined through, in join order.
+
+        The batch is attributed from one invite fetch when its uses are unambiguous: no role
+        invite used, or a single one used once per member. Otherwise the members it cannot tell
+        apart only get the default roles and the guild's joins stop being batched until its
+        queue runs empty, so each of the next joins is attributed from a fetch of its own
+        wherever the rate limit allows one.
+        """
+        if not self.invite_cache.has_role_invites(guild.id):
+            metrics.JOINS.inc("false", amount=len(members))
+            return [None] * len(members)  # Nothing to attribute, so skip the invite fetch entirely
+        rounds = await self._collect_uses(guild, members)
+        invite_codes = attribute(rounds) if rounds else [None] * len(members)
+        attributed = [code for code in invite_codes if code]
+        uses = sum(sum(used.values()) for _, _, used in rounds or ())
+        if len(attributed) < uses:
+            logging.warning("Ambiguous invite attribution in %s: %d of %d role invite uses attributed to %d joins, "
+                            "the others only get the default roles.", guild.name, len(attributed), uses,
+                            len(members), extra={"guild_id": guild.id})
+        metrics.JOINS.inc("true", amount=len(attributed))
+        metrics.JOINS.inc("false", amount=len(members) - len(attributed))
+        logging.info("Attributed %d of %d joins in %s to role invites.", len(attributed), len(members), guild.name,
+                     extra={"guild_id": guild.id})
+        return invite_codes
+
+    async def _collect_uses(self, guild: discord.Guild,
+                            members: list[discord.Member]) -> typing.Optional[list[tuple[int, int, dict[str, int]]]]:
+        """Fetch the invites and extend ``members`` to exactly the joins the fetched uses count.
+
+        Join events can arrive after a fetch that already counts their use, so the joins arriving
+        within ``SETTLE_DELAY`` are split by their join time: earlier ones are added to ``members``,
+        later ones go back to the join queue. Joins too close to the fetch to tell are added too
+        and the invites are fetched once more, which counts them for sure, unless no role invite
+        was used and they can wait for the next batch either way. Returns the rounds for
+        ``attribute``, or None if the snapshot was invalidated and the uses cannot be trusted.
+        """
+        rounds = []
+        trusted = True
+        while True:
+            members.extend(self.join_queue.take(guild.id))  # Their events arrived first, so the fetch counts them
+            sent = time.time()
+            used = self.invite_cache.update(guild.id, await guild.invites())
+            fetched_at = time.time()
+            trusted = trusted and used is not None
+            deadline = time.monotonic() + self.SETTLE_DELAY
+            arrived = self.join_queue.take(guild.id)
+            while not arrived or self._joined_at(arrived[-1]) <= fetched_at + self.CLOCK_SKEW:
+                if (remaining := deadline - time.monotonic()) <= 0:
+                    break
+                await self.join_queue.wait(guild.id, remaining)
+                arrived.extend(self.join_queue.take(guild.id))
+            # Discord counts the uses between sending the request and its response, which may have waited on the rate limit
+            counted_before = max(sent, fetched_at - self.ROUND_TRIP) - self.CLOCK_SKEW
+            cut = next((index for index, member in enumerate(arrived) if self._joined_at(member) >= counted_before),
+                       len(arrived))
+            members.extend(arrived[:cut])
+            later = arrived[cut:]
+            uncertain = sum(self._joined_at(member) <= fetched_at + self.CLOCK_SKEW for member in later)
+            certain = len(members) - sum(known + unknown for known, unknown, _ in rounds)
+            if uncertain and used:
+                members.extend(later)
+                rounds.append((certain, uncertain, used))
+                continue
+            self.join_queue.put_back(guild.id, later)
+            rounds.append((certain, 0, used or {}))
+            return rounds if trusted else None
 
-        if invites_to_add:
-            logging.info(f"Added {len(invites_to_add)} invites to the database that were missing.")
+    @staticmethod
+    def _joined_at(member: discord.Member) -> float:
+        return member.joined_at.timestamp() if member.joined_at else time.time()
 
-        # Optionally, you can remove invites from the database that are no longer present on the server
-        invites_to_delete = db_invite_ids - current_invites.keys()
+    def owns_guild(self, guild_id: int) -> bool:
+        """Whether the guild is served by one of the shards of this process."""
+        return shard_of(guild_id, self.bot.shard_count) in self.bot.shards
 
-        if invites_to_delete:
-            # Create a placeholder for bulk delete
-            placeholders = ', '.join('?' for _ in invites_to_delete)
-            cursor.execute(f"DELETE FROM invites WHERE invite_id IN ({placeholders})", tuple(invites_to_delete))
-            logging.info(
-                f"Deleted {len(invites_to_delete)} invites from the database as they are no longer present on the server.")
+    def _scheduler(self, shard_id: int) -> ReconcileScheduler:
+        """The reconciliation scheduler of a shard, each shard's guilds are scheduled separately."""
+        if shard_id not in self.reconcile_schedulers:
+            self.reconcile_schedulers[shard_id] = ReconcileScheduler(self.bot, self._reconcile_guild,
+                                                                     interval=self.RECONCILE_INTERVAL,
+                                                                     shard_id=shard_id)
+        return self.reconcile_schedulers[shard_id]
 
-        conn.commit()
-        conn.close()
+    def _scheduler_for(self, guild_id: int) -> ReconcileScheduler:
+        return self._scheduler(shard_of(guild_id, self.bot.shard_count))
 
-    @staticmethod
-    async def _give_role(member: discord.Member, invites: list[discord.Invite]):
-        """Assign role based on the invite used."""
-        guild_id = str(member.guild.id)
-
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-
-        # Get invite data which includes uses
-        cursor.execute("SELECT invite_id, role_id, uses FROM invites WHERE guild_id = ?", (guild_id,))
-        guild_invites_data = cursor.fetchall()
-
-        for invite_id, role_id, db_uses in guild_invites_data:
-            invite = next((i for i in invites if i.id == invite_id), None)
-            if invite and invite.uses > db_uses:  # Compare against uses from the database
-                role = member.guild.get_role(role_id)
-                if role:
-                    try:
-                        await member.add_roles(role)
-                        logging.info(f"Assigned role {role.name} to {member.name} using invite {invite.code}.")
-                        # Update invite uses in the database
-                        cursor.execute("UPDATE invites SET uses = uses + 1 WHERE invite_id = ?", (invite.id,))
-                        conn.commit()
-                    except discord.Forbidden:
-                        logging.warning(f"Failed to assign role {role.name} to {member.name}. Missing permissions.")
-                    except Exception as e:
-                        logging.error(f"Error assigning role {role.name} to {member.name}: {str(e)}")
-                else:
-                    logging.error(f"Role with ID {role_id} does not exist. Removing invite {invite_id} from database.")
-                    delete_invite(invite_id)
-                break  # Exit the loop after assigning the role
-
-        conn.close()
+    @tasks.loop(seconds=1)
+    async def clean_up_invites(self):
+        """Reconcile the next slice of guilds of every shard; a full pass is spread across the scheduler interval."""
+        with metrics.LOOP_ITERATION.time("clean_up_invites"):
+            await asyncio.gather(*(self._scheduler(shard_id).tick() for shard_id in self.bot.shards))
+
+    @clean_up_invites.before_loop
+    async def before_clean_up_invites(self):
+        await self.bot.wait_until_ready()
+
+    async def _reconcile_guild(self, guild: discord.Guild) -> bool:
+        """Ensure the guild's invites are present in the database and remove any that are not."""
+        invites = [
+            (invite.id, invite.inviter.id if invite.inviter else None, invite.uses, invite.max_uses, invite.channel.id)
+            for invite in await guild.invites()
+        ]
+        added, updated, deleted = await reconcile_invites(guild.id, invites)
+        if added:
+            logging.info("Added %d invites of %s to the database that were missing.", added, guild.name,
+                         extra={"guild_id": guild.id})
+        if deleted:
+            for invite_id in deleted:
+                self.invite_cache.forget(guild.id, invite_id)
+                self.invite_timers.forget(invite_id)
+            logging.info("Deleted %d invites of %s from the database as they are no longer present on the server.",
+                         len(deleted), guild.name, extra={"guild_id": guild.id})
+        return bool(added or updated or deleted)
+
+    def _forget_invite(self, guild_id: int, invite_id: str) -> None:
+        """Drop an invite from the database, the attribution cache and the timers."""
+        self.invite_writes.delete(invite_id)
+        self.invite_cache.forget(guild_id, invite_id)
+        self.invite_timers.forget(invite_id)
+
+    async def _revoke_invite(self, guild_id: int, invite_id: str, reason: str) -> None:
+        """Delete a role invite on Discord and forget it, it may already be gone if it expired there."""
+        try:
+            await self.bot.delete_invite(invite_id)
+        except discord.NotFound:
+            pass
+        except discord.Forbidden as e:
+            logging.error("Could not revoke invite %s (%s), it no longer grants its role: %s", invite_id, reason, e,
+                          extra={"guild_id": guild_id, "invite": invite_id})
+            self._forget_invite(guild_id, invite_id)
+            return
+        except discord.HTTPException as e:
+            logging.warning("Could not revoke invite %s (%s), retrying: %s", invite_id, reason, e,
+                            extra={"guild_id": guild_id, "invite": invite_id})
+            self.invite_cache.forget(guild_id, invite_id)  # No role through it while it waits for the retry
+            self.invite_timers.retry(guild_id, invite_id, reason)
+            return
+        self._forget_invite(guild_id, invite_id)
+        logging.info("Revoked invite %s, %s.", invite_id, reason, extra={"guild_id": guild_id, "invite": invite_id})
+
+    def _default_roles(self, guild: discord.Guild) -> list[discord.Role]:
+        """The guild's default roles that still exist, straight from the config cache."""
+        role_ids = self.guild_configs.get(guild.id).default_roles
+        return [role for role_id in role_ids if (role := guild.get_role(role_id))]
+
+    async def _give_role(self, member: discord.Member, invite_code: typing.Optional[str],
+                         default_roles: list[discord.Role]):
+        """Queue the default roles and the role of the invite used as a single member edit."""
+        roles = list(default_roles)
+        used_up = False
+        if invite_code is not None:
+            role_id = self.invite_cache.role_for(member.guild.id, invite_code)
+            if role := member.guild.get_role(role_id):
+                roles.append(role)
+                logging.info("%s joined using invite %s for role %s.", member.name, invite_code, role.name,
+                             extra={"guild_id": member.guild.id, "member_id": member.id, "invite": invite_code})
+                self.invite_writes.increment(invite_code)
+                joined_at = member.joined_at.timestamp() if member.joined_at else time.time()
+                self.invite_writes.attribute(member.guild.id, member.id, invite_code, role.id, joined_at)
+                if used_up := self.invite_timers.use(invite_code):
+                    self.invite_timers.forget(invite_code)  # Later joins of the batch must not revoke it again
+            else:
+                logging.error("Role with ID %s does not exist. Removing invite %s from database.", role_id,
+                              invite_code, extra={"guild_id": member.guild.id, "invite": invite_code})
+                self._forget_invite(member.guild.id, invite_code)
+        if roles:
+            self.role_grants.grant(member, roles)
+        if used_up:
+            await self._revoke_invite(member.guild.id, invite_code, "max uses reached")
 
     @commands.Cog.listener()
     async def on_member_update(self, before: discord.Member, after: discord.Member):
-        if before in self.pending and before.pending != after.pending:
-            try:
-                guild_invites_list = await after.guild.invites()
-            except errors.Forbidden:
-                return
-            if default_role := get_default_role(before.guild.id):
-                await after.add_roles(after.guild.get_role(default_role))
-            self.pending.remove(before)
-            return await self._give_role(after, guild_invites_list)
-
-    def cog_unload(self):
-        if self.clean_up_invites:
-            self.clean_up_invites.cancel()
-
-
-
-async def setup(role_invite_bot: Role_Invite_Bot) -> None:
-    check_invites = RoleInvite(Role_Invite_Bot).clean_up_invites
-    if not check_invites.is_running():
-        check_invites.start()
+        if before.pending != after.pending and after in self.pending:
+            invite_code = await self.pending.pop(after.guild.id, after.id)
+            return await self._give_role(after, invite_code, self._default_roles(after.guild))
+
+    async def cog_load(self):
+        self._startup_task = asyncio.create_task(self.start_up())
+        self.clean_up_invites.start()
+        self.evict_pending_members.start()
+        self.invite_timers.start()
+        if port := os.getenv("METRICS_PORT"):
+            # Workers of a sharded deployment listen on consecutive ports
+            self._metrics_server = await metrics.start_http_server(int(port) + int(SHARD_PROCESS or 0))
+
+    async def cog_unload(self):
+        if self._startup_task:
+            self._startup_task.cancel()
+        self.join_queue.close()
+        await self.role_grants.close()
+        self.invite_timers.close()
+        self.clean_up_invites.cancel()
+        self.evict_pending_members.cancel()
+        await self.invite_writes.close()
+        if self._metrics_server:
+            await self._metrics_server.cleanup()
+
+
+
+async def setup(role_invite_bot: commands.Bot) -> None:
     await role_invite_bot.add_cog(RoleInvite(role_invite_bot))
     await role_invite_bot.add_cog(ClearCommands(role_invite_bot))
 
-@Role_Invite_Bot.event
-async def on_ready() -> None:
-    await setup(Role_Invite_Bot)
-    await Role_Invite_Bot.tree.sync()
-    print(f"Bot is ready! Logged in as {Role_Invite_Bot.user}")
-
 
-Role_Invite_Bot.run(os.getenv('TOKEN'))
+def main() -> None:
+    # Configure logging, LOG_FORMAT=json writes one JSON object per record
+    log_listener = setup_logging(f'roleinvite.{SHARD_PROCESS}.log' if SHARD_PROCESS else 'roleinvite.log',
+                                 structured=os.getenv("LOG_FORMAT") == "json")
+    init_db()
+    if SHARD_PROCESSES > 1 and SHARD_PROCESS is None:
+        # Every worker needs the same shard count, so it cannot be left to Discord's recommendation
+        close_db()
+        log_listener.stop()
+        sys.exit(launch(SHARD_PROCESSES, SHARD_COUNT or SHARD_PROCESSES))
+
+    if SHARD_PROCESS is not None:
+        role_invite_bot = RoleInviteBot(
+            command_prefix="!", intents=intents, shard_count=SHARD_COUNT,
+            shard_ids=shard_ids_for(int(SHARD_PROCESS), SHARD_PROCESSES, SHARD_COUNT)
+        )
+    else:
+        role_invite_bot = RoleInviteBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT)
+    metrics.instrument_http(role_invite_bot.http)
+    role_invite_bot.run(os.getenv('TOKEN'), log_handler=None)  # discord.py logs through our root logger
+    close_db()
+    log_listener.stop()
+
+
+# Importing this module, e.g. to drive the cogs from a script, must not start the bot
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Per-guild pipeline that applies role grants in as few REST calls as possible."""
+import asyncio
+import logging
+import time
+import typing
+
+import discord
+
+from metrics import JOIN_TO_ROLE, ROLE_GRANTS
+
+
+class RoleGrants:
+    """Applies every member's missing roles in a single member edit, serialised per guild.
+
+    Member edits of a guild share one rate limit bucket, so each guild gets one worker and
+    grants queued for the same member are merged before they are sent. Grants that still
+    fail with 429 or 5xx after discord.py's own retries are retried with exponential backoff.
+    """
+
+    def __init__(self, max_attempts: int = 5, backoff: float = 2.0):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._pending: dict[int, dict[int, tuple[discord.Member, set[discord.Role]]]] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._started = time.monotonic()
+        self._granted = False
+
+    def grant(self, member: discord.Member, roles: typing.Iterable[discord.Role]) -> None:
+        pending = self._pending.setdefault(member.guild.id, {})
+        if member.id in pending:
+            pending[member.id][1].update(roles)
+        else:
+            pending[member.id] = (member, set(roles))
+        if member.guild.id not in self._workers:
+            self._workers[member.guild.id] = asyncio.create_task(self._run(member.guild.id))
+
+    async def _run(self, guild_id: int) -> None:
+        try:
+            pending = self._pending[guild_id]
+            while pending:
+                member, roles = pending.pop(next(iter(pending)))
+                try:
+                    await self._apply(member, roles)
+                except asyncio.CancelledError:
+                    pending.setdefault(member.id, (member, roles))  # Still owed, so close() can report it
+                    raise
+        finally:
+            self._workers.pop(guild_id, None)
+            if not self._pending.get(guild_id):
+                self._pending.pop(guild_id, None)
+
+    async def _apply(self, member: discord.Member, roles: set[discord.Role]) -> None:
+        missing = [role for role in roles if role not in member.roles]
+        if not missing:
+            return
+        names = ', '.join(role.name for role in missing)
+        fields = {"guild_id": member.guild.id, "member_id": member.id}
+        for attempt in range(self.max_attempts):
+            try:
+                await member.add_roles(*missing, atomic=False)
+                ROLE_GRANTS.inc("success")
+                if not self._granted:
+                    self._granted = True
+                    logging.info(f"First role grant went out {time.monotonic() - self._started:.1f}s after startup.")
+                if member.joined_at:
+                    fields["latency"] = (discord.utils.utcnow() - member.joined_at).total_seconds()
+                    JOIN_TO_ROLE.observe(fields["latency"])
+                logging.info("Assigned %s to %s.", names, member.name, extra=fields)
+                return
+            except discord.Forbidden:
+                logging.warning("Failed to assign %s to %s. Missing permissions.", names, member.name, extra=fields)
+                ROLE_GRANTS.inc("forbidden")
+                return
+            except discord.NotFound:
+                ROLE_GRANTS.inc("member_left")
+                return  # The member left before the grant went out
+            except discord.RateLimited as e:
+                delay = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    logging.error("Error assigning %s to %s: %s", names, member.name, e, extra=fields)
+                    ROLE_GRANTS.inc("failed")
+                    return
+                delay = self.backoff * 2 ** attempt
+            ROLE_GRANTS.inc("retry")
+            await asyncio.sleep(delay)
+        logging.error("Gave up assigning %s to %s after %d attempts.", names, member.name, self.max_attempts,
+                      extra=fields)
+        ROLE_GRANTS.inc("failed")
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Give the workers ``timeout`` seconds to apply the queued grants, then drop and log the rest."""
+        if self._workers:
+            await asyncio.wait(list(self._workers.values()), timeout=timeout)
+        workers = list(self._workers.values())
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        for guild_id, pending in self._pending.items():
+            for member, roles in pending.values():
+                logging.error("Dropped the grant of %s to %s on shutdown.", ', '.join(role.name for role in roles),
+                              member.name, extra={"guild_id": guild_id, "member_id": member.id})
+        self._workers.clear()
+        self._pending.clear()
@@ -0,0 +1,104 @@
+"""Staggered scheduling of the per-guild invite reconciliation."""
+import asyncio
+import collections
+import logging
+import math
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+from metrics import RECONCILE_PASS, RECONCILE_QUEUE
+
+
+class ReconcileScheduler:
+    """Spreads guild reconciliation across ``interval`` seconds in slices taken every ``tick``.
+
+    Guilds marked dirty by gateway invite events go first, at most ``max_in_flight``
+    invite fetches run at once, and guilds that keep coming back unchanged or Forbidden
+    are skipped for exponentially more passes, up to ``max_backoff``. With a ``shard_id``
+    only the guilds of that shard are reconciled.
+    """
+
+    def __init__(self, bot: commands.Bot, reconcile: typing.Callable[[discord.Guild], typing.Awaitable[bool]],
+                 interval: float = 10.0, tick: float = 1.0, max_in_flight: int = 4, max_backoff: int = 32,
+                 shard_id: typing.Optional[int] = None):
+        self.bot = bot
+        self.shard_id = shard_id
+        self._reconcile = reconcile
+        self.interval = interval
+        self.tick_length = tick
+        self.max_backoff = max_backoff
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._queue: collections.deque[int] = collections.deque()
+        self._dirty: dict[int, None] = {}
+        self._backoff: dict[int, int] = {}
+        self._skip: dict[int, int] = {}
+        self._reconciled: set[int] = set()
+        self._slice = 1
+        self._pass_started: typing.Optional[float] = None
+        self._pass_finished = True
+        self.last_pass_duration = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Guilds still waiting in the current pass, dirty ones included."""
+        return len(self._queue) + len(self._dirty)
+
+    def mark_dirty(self, guild_id: int) -> None:
+        self._dirty[guild_id] = None
+        self._backoff[guild_id] = 1
+        self._skip[guild_id] = 0
+
+    def _start_pass(self) -> None:
+        self._pass_started = time.monotonic()
+        self._pass_finished = False
+        self._reconciled.clear()
+        for guild in self.bot.guilds:
+            if self.shard_id is not None and guild.shard_id != self.shard_id:
+                continue
+            if self._skip.get(guild.id, 0) > 0:
+                self._skip[guild.id] -= 1
+            else:
+                self._queue.append(guild.id)
+        self._slice = max(1, math.ceil(len(self._queue) * self.tick_length / self.interval))
+
+    async def tick(self) -> None:
+        """Reconcile the next slice of guilds, dirty guilds first."""
+        if not self._queue and (self._pass_started is None
+                                or time.monotonic() - self._pass_started >= self.interval):
+            self._start_pass()
+        guild_ids = list(self._dirty)
+        self._dirty.clear()
+        self._reconciled.update(guild_ids)
+        while self._queue and len(guild_ids) < self._slice:
+            guild_id = self._queue.popleft()
+            if guild_id not in self._reconciled:
+                self._reconciled.add(guild_id)
+                guild_ids.append(guild_id)
+        guilds = [guild for guild_id in guild_ids if (guild := self.bot.get_guild(guild_id))]
+        await asyncio.gather(*(self._run(guild) for guild in guilds))
+        RECONCILE_QUEUE.set(self.queue_depth, self.shard_id)
+        if not self._queue and not self._pass_finished:
+            self._pass_finished = True
+            self.last_pass_duration = time.monotonic() - self._pass_started
+            RECONCILE_PASS.observe(self.last_pass_duration)
+            if self.last_pass_duration > self.interval:
+                logging.warning(f"Invite reconciliation pass took {self.last_pass_duration:.1f}s, "
+                                f"longer than its {self.interval:.0f}s interval.")
+
+    async def _run(self, guild: discord.Guild) -> None:
+        async with self._semaphore:
+            try:
+                changed = await self._reconcile(guild)
+            except discord.Forbidden:
+                self._backoff[guild.id] = self.max_backoff
+                self._skip[guild.id] = self.max_backoff - 1
+                return
+            except discord.HTTPException as e:
+                logging.warning(f"Failed to reconcile invites of {guild.name}: {e}")
+                return
+        backoff = 1 if changed else min(self._backoff.get(guild.id, 1) * 2, self.max_backoff)
+        self._backoff[guild.id] = backoff
+        self._skip[guild.id] = backoff - 1
@@ -0,0 +1,61 @@
+"""Splitting the bot's shards across several worker processes."""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    """The shard Discord delivers a guild's events on."""
+    return (guild_id >> 22) % shard_count
+
+
+def shard_ids_for(process: int, processes: int, shard_count: int) -> list[int]:
+    """The contiguous range of shards owned by the worker with index ``process``."""
+    per_process, remainder = divmod(shard_count, processes)
+    start = process * per_process + min(process, remainder)
+    return list(range(start, start + per_process + (process < remainder)))
+
+
+def launch(processes: int, shard_count: int, restart_delay: float = 5.0) -> int:
+    """Run this script once per worker process and restart workers that crash.
+
+    Each worker gets its index in ``SHARD_PROCESS``, SIGINT and SIGTERM are forwarded to
+    all workers and the launcher returns once every worker has exited cleanly.
+    """
+    if processes > shard_count:
+        logging.warning(f"Only starting {shard_count} workers, there are not enough shards for {processes}.")
+        processes = shard_count
+
+    def spawn(process: int) -> subprocess.Popen:
+        env = dict(os.environ, SHARD_PROCESS=str(process), SHARD_PROCESSES=str(processes),
+                   SHARD_COUNT=str(shard_count))
+        logging.info(f"Starting worker {process} for shards {shard_ids_for(process, processes, shard_count)}.")
+        return subprocess.Popen([sys.executable, *sys.argv], env=env)
+
+    workers = {process: spawn(process) for process in range(processes)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for worker in workers.values():
+            worker.send_signal(signum)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while workers:
+        for process, worker in list(workers.items()):
+            code = worker.poll()
+            if code is None:
+                continue
+            if code == 0 or stopping:
+                del workers[process]
+            else:
+                logging.error(f"Worker {process} exited with code {code}, restarting it in {restart_delay:.0f}s.")
+                time.sleep(restart_delay)
+                workers[process] = spawn(process)
+        time.sleep(1)
+    return 0
@@ -0,0 +1,9 @@
+import re
+
+
+def timer(time: str) -> int:
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    match = re.fullmatch(r'([0-9]*\.?[0-9]+)([smhd])', time)
+    if match is None:
+        raise ValueError("Invalid time input")
+    return int(float(match[1]) * units[match[2]])